@@ -37,6 +37,8 @@ import sys
 import time
 import cmath
 import numpy
+import multiprocessing
+import laser_bezier
 import codecs
 import random
 import gettext
@@ -83,6 +85,7 @@ straight_tolerance = 0.0001
 straight_distance_tolerance = 0.0001
 engraving_tolerance = 0.0001
 loft_lengths_tolerance = 0.0000001
+dxfpoints_tolerance = 0.0001
 options = {}
 defaults = {
 'header': """
@@ -97,6 +100,8 @@ G1 X0 Y0 # Park head to invoke laser off
 
 intersection_recursion_depth = 10
 intersection_tolerance = 0.00001
+gcode_write_buffer = 1 << 20
+parallel_tasks_per_job = 4
 
 styles = {
         "loft_style" : {
@@ -948,6 +953,15 @@ def csp_reverse(csp) :
     return csp
 
 
+def csp_transform(csp, m) :
+    # Applies affine matrix [[a,c,e],[b,d,f]] to all points of csp as
+    # one matrix multiply, returns new csp
+    points = numpy.array([sp for subpath in csp for sp in subpath], dtype=float).reshape(-1,2)
+    m = numpy.array(m, dtype=float)
+    points = iter((numpy.dot(points, m[:2,:2].T) + m[:2,2]).tolist())
+    return [ [ [next(points), next(points), next(points)] for sp in subpath ] for subpath in csp ]
+
+
 def csp_normalized_slope(sp1,sp2,t) :
     ax,ay,bx,by,cx,cy,dx,dy=bezmisc.bezierparameterize((sp1[1][:],sp1[2][:],sp2[0][:],sp2[1][:]))
     if sp1[1]==sp2[1]==sp1[2]==sp2[0] : return [1.,0.]
@@ -1824,87 +1838,182 @@ def csp_offset(csp, r) :
 ###        Calculates biarc approximation of cubic super path segment
 ###        splits segment if needed or approximates it with straight line
 ###
+###        Fits are made on flat floats in segment local coordinates (start at
+###        origin, chord along x) and memoized in biarc_cache, so repeated
+###        shapes (e.g. glyphs of text converted to paths) are fitted once.
+###
 ################################################################################
-def biarc(sp1, sp2, z1, z2, depth=0):
-    def biarc_split(sp1,sp2, z1, z2, depth):
-        if depth<options.biarc_max_split_depth:
-            sp1,sp2,sp3 = csp_split(sp1,sp2)
-            l1, l2 = cspseglength(sp1,sp2), cspseglength(sp2,sp3)
-            if l1+l2 == 0 : zm = z1
-            else : zm = z1+(z2-z1)*l1/(l1+l2)
-            return biarc(sp1,sp2,z1,zm,depth+1)+biarc(sp2,sp3,zm,z2,depth+1)
-        else: return [ [sp1[1],'line', 0, 0, sp2[1], [z1,z2]] ]
-
-    P0, P4 = P(sp1[1]), P(sp2[1])
-    TS, TE, v = (P(sp1[2])-P0), -(P(sp2[0])-P4), P0 - P4
-    tsa, tea, va = TS.angle(), TE.angle(), v.angle()
-    if TE.mag()<straight_distance_tolerance and TS.mag()<straight_distance_tolerance:
+biarc_cache = {}
+biarc_cache_precision = 6
+biarc_error_tolerance = 0.01
+# Curve is sampled at t = j/80, refinement steps use every 8th, 4th, 2nd and each sample
+biarc_error_bernstein = laser_bezier.bernstein(numpy.linspace(0., 1., 81)).T
+biarc_error_steps = [numpy.arange(0, 81, 8), numpy.arange(0, 81, 4), numpy.arange(0, 81, 2), numpy.arange(0, 81, 1)]
+
+
+def biarc_arc_distance(x, y, x0, y0, x1, y1, cx, cy, a) :
+    # Distance from points (x,y) to arc from (x0,y0) to (x1,y1) around (cx,cy) by angle a
+    r = math.hypot(x0-cx, y0-cy)
+    d = numpy.hypot(x-cx, y-cy)
+    alpha = numpy.arctan2(y-cy, x-cx) - math.atan2(y0-cy, x0-cx)
+    alpha = numpy.where(a*alpha<0, numpy.where(alpha>0, alpha-math.pi2, alpha+math.pi2), alpha)
+    on_arc = (  ((-straight_tolerance<=alpha) & (alpha<=a+straight_tolerance)) | ((a-straight_tolerance<=alpha) & (alpha<=straight_tolerance)) |
+                (numpy.minimum(abs(alpha), abs(alpha-a))<straight_tolerance) )
+    ends = numpy.minimum(numpy.hypot(x-x0, y-y0), numpy.hypot(x-x1, y-y1))
+    return numpy.where(on_arc, numpy.where(d>0, abs(d-r), 0.), ends)
+
+
+def biarc_error_exceeds(b, arc1, arc2, limit = 1.) :
+    # Same refinement as csp_to_arc_distance: sampling is doubled while the
+    # maximal distance changes, but all samples are evaluated at once
+    x, y = numpy.dot(b[0::2], biarc_error_bernstein), numpy.dot(b[1::2], biarc_error_bernstein)
+    d = numpy.minimum(biarc_arc_distance(x, y, *arc1), biarc_arc_distance(x, y, *arc2))
+    d1 = 0.
+    for step in biarc_error_steps :
+        dl, d1 = d1, max(d1, d[step].max())
+        if d1 > limit : return True
+        if abs(d1-dl) <= biarc_error_tolerance : break
+    return False
+
+
+def biarc_arc_params(x0, y0, x1, y1, x2, y2) :
+    dx, dy = (x0+x2)/2, (y0+y2)/2
+    h = math.hypot(dx-x1, dy-y1)
+    if h==0 : return None
+    k = ((dx-x0)**2 + (dy-y0)**2)/h/h
+    cx, cy = dx - (x1-dx)*k, dy - (y1-dy)*k
+    p0a, p1a, p2a = math.atan2(y0-cy, x0-cx)%math.pi2, math.atan2(y1-cy, x1-cx)%math.pi2, math.atan2(y2-cy, x2-cx)%math.pi2
+    alpha = (p2a - p0a) % math.pi2
+    if (p0a<p2a and (p1a<p0a or p2a<p1a)) or (p2a<p1a<p0a) :
+        alpha = -math.pi2+alpha
+    if abs(cx)>1000000 or abs(cy)>1000000 or math.hypot(cx-x0, cy-y0)<0.1 :
+        return None
+    return cx, cy, alpha
+
+
+def biarc_fit(b, depth, f1 = 0., f2 = 1.) :
+    # b = [x0,y0,x1,y1,x2,y2,x3,y3] control points of the segment.
+    # Returns pieces (type, end x, end y, center x, center y, angle, z fraction at start, z fraction at end)
+    def split() :
+        if depth>=options.biarc_max_split_depth : return line
+        x0, y0, x1, y1, x2, y2, x3, y3 = b
+        x12, y12, x23, y23, x34, y34 = (x0+x1)/2, (y0+y1)/2, (x1+x2)/2, (y1+y2)/2, (x2+x3)/2, (y2+y3)/2
+        x1223, y1223, x2334, y2334 = (x12+x23)/2, (y12+y23)/2, (x23+x34)/2, (y23+y34)/2
+        x, y = (x1223+x2334)/2, (y1223+y2334)/2
+        # Halves lengths (used for z only) are taken from the sampled polyline
+        l = numpy.hypot(*numpy.diff(numpy.dot(numpy.reshape(b, (4,2)).T, biarc_error_bernstein)))
+        l1, l2 = l[:40].sum(), l[40:].sum()
+        fm = f1 if l1+l2 == 0 else f1+(f2-f1)*l1/(l1+l2)
+        return ( biarc_fit([x0,y0,x12,y12,x1223,y1223,x,y], depth+1, f1, fm) +
+                 biarc_fit([x,y,x2334,y2334,x34,y34,x3,y3], depth+1, fm, f2) )
+
+    x0, y0, x1, y1, x2, y2, x4, y4 = b
+    line = [ ('line', x4, y4, 0., 0., 0., f1, f2) ]
+    tsx, tsy, tex, tey, vx, vy = x1-x0, y1-y0, x4-x2, y4-y2, x0-x4, y0-y4
+    ts, te, v = math.hypot(tsx, tsy), math.hypot(tex, tey), math.hypot(vx, vy)
+    tsa, tea = math.atan2(tsy, tsx), math.atan2(tey, tex)
+    if te<straight_distance_tolerance and ts<straight_distance_tolerance :
         # Both tangents are zerro - line straight
-        return [ [sp1[1],'line', 0, 0, sp2[1], [z1,z2]] ]
-    if TE.mag() < straight_distance_tolerance:
-        TE = -(TS+v).unit()
-        r = TS.mag()/v.mag()*2
-    elif TS.mag() < straight_distance_tolerance:
-        TS = -(TE+v).unit()
-        r = 1/( TE.mag()/v.mag()*2 )
-    else:
-        r=TS.mag()/TE.mag()
-    TS, TE = TS.unit(), TE.unit()
+        return line
+    if te<straight_distance_tolerance :
+        if v==0 : return split()
+        tex, tey = -(tsx+vx), -(tsy+vy)
+        r = ts/v*2
+    elif ts<straight_distance_tolerance :
+        if v==0 : return split()
+        tsx, tsy = -(tex+vx), -(tey+vy)
+        r = 1/( te/v*2 )
+    else :
+        r = ts/te
+    ts, te = math.hypot(tsx, tsy), math.hypot(tex, tey)
+    if ts : tsx, tsy = tsx/ts, tsy/ts
+    if te : tex, tey = tex/te, tey/te
+    ts, te = math.hypot(tsx, tsy), math.hypot(tex, tey)
     tang_are_parallel = ((tsa-tea)%math.pi<straight_tolerance or math.pi-(tsa-tea)%math.pi<straight_tolerance )
-    if ( tang_are_parallel  and
-                ((v.mag()<straight_distance_tolerance or TE.mag()<straight_distance_tolerance or TS.mag()<straight_distance_tolerance) or
-                    1-abs(TS*v/(TS.mag()*v.mag()))<straight_tolerance)    ):
-                # Both tangents are parallel and start and end are the same - line straight
-                # or one of tangents still smaller then tollerance
-
-                # Both tangents and v are parallel - line straight
-        return [ [sp1[1],'line', 0, 0, sp2[1], [z1,z2]] ]
-
-    c,b,a = v*v, 2*v*(r*TS+TE), 2*r*(TS*TE-1)
-    if v.mag()==0:
-        return biarc_split(sp1, sp2, z1, z2, depth)
-    asmall, bsmall, csmall = abs(a)<10**-10,abs(b)<10**-10,abs(c)<10**-10
-    if         asmall and b!=0:    beta = -c/b
-    elif     csmall and a!=0:    beta = -b/a
-    elif not asmall:
-        discr = b*b-4*a*c
-        if discr < 0:    raise ValueError(a,b,c,discr)
+    if ( tang_are_parallel and
+                ((v<straight_distance_tolerance or te<straight_distance_tolerance or ts<straight_distance_tolerance) or
+                    1-abs((tsx*vx+tsy*vy)/(ts*v))<straight_tolerance) ) :
+        # Both tangents and v are parallel - line straight
+        return line
+    if v==0 :
+        return split()
+
+    c, b_, a = v*v, 2*(vx*(r*tsx+tex) + vy*(r*tsy+tey)), 2*r*(tsx*tex+tsy*tey-1)
+    asmall, bsmall, csmall = abs(a)<10**-10, abs(b_)<10**-10, abs(c)<10**-10
+    if asmall and b_!=0 :    beta = -c/b_
+    elif csmall and a!=0 :    beta = -b_/a
+    elif not asmall :
+        discr = b_*b_-4*a*c
+        if discr < 0 :    raise ValueError(a,b_,c,discr)
         disq = discr**.5
-        beta1 = (-b - disq) / 2 / a
-        beta2 = (-b + disq) / 2 / a
-        if beta1*beta2 > 0 :    raise ValueError(a,b,c,disq,beta1,beta2)
+        beta1 = (-b_ - disq) / 2 / a
+        beta2 = (-b_ + disq) / 2 / a
+        if beta1*beta2 > 0 :    raise ValueError(a,b_,c,disq,beta1,beta2)
         beta = max(beta1, beta2)
-    elif    asmall and bsmall:
-        return biarc_split(sp1, sp2, z1, z2, depth)
+    else :
+        return split()
     alpha = beta * r
     ab = alpha + beta
-    P1 = P0 + alpha * TS
-    P3 = P4 - beta * TE
-    P2 = (beta / ab)  * P1 + (alpha / ab) * P3
-
-
-    def calculate_arc_params(P0,P1,P2):
-        D = (P0+P2)/2
-        if (D-P1).mag()==0: return None, None
-        R = D - ( (D-P0).mag()**2/(D-P1).mag() )*(P1-D).unit()
-        p0a, p1a, p2a = (P0-R).angle()%(2*math.pi), (P1-R).angle()%(2*math.pi), (P2-R).angle()%(2*math.pi)
-        alpha =  (p2a - p0a) % (2*math.pi)
-        if (p0a<p2a and  (p1a<p0a or p2a<p1a))    or    (p2a<p1a<p0a) :
-            alpha = -2*math.pi+alpha
-        if abs(R.x)>1000000 or abs(R.y)>1000000  or (R-P0).mag()<0.1 :
-            return None, None
+    p1x, p1y = x0 + alpha*tsx, y0 + alpha*tsy
+    p3x, p3y = x4 - beta*tex, y4 - beta*tey
+    p2x, p2y = (beta/ab)*p1x + (alpha/ab)*p3x, (beta/ab)*p1y + (alpha/ab)*p3y
+
+    arc1 = biarc_arc_params(x0, y0, p1x, p1y, p2x, p2y)
+    arc2 = biarc_arc_params(p2x, p2y, p3x, p3y, x4, y4)
+    if arc1==None or arc2==None : return line
+    (c1x, c1y, a1), (c2x, c2y, a2) = arc1, arc2
+    r1, r2 = math.hypot(c1x-x0, c1y-y0), math.hypot(c2x-p2x, c2y-p2y)
+    if r1<straight_tolerance or r2<straight_tolerance : return line
+
+    # Error is not needed when segment can not be split anymore
+    if depth<options.biarc_max_split_depth and biarc_error_exceeds(numpy.array(b), (x0,y0,p2x,p2y,c1x,c1y,a1), (p2x,p2y,x4,y4,c2x,c2y,a2)) :
+        return split()
+    fm = f2 if r2*a2 == 0 else f1 + (f2-f1)*abs(r1*a1)/(abs(r2*a2)+abs(r1*a1))
+    return [ ('arc', p2x, p2y, c1x, c1y, a1, f1, fm), ('arc', x4, y4, c2x, c2y, a2, fm, f2) ]
+
+
+def biarc(sp1, sp2, z1, z2, depth=0):
+    # Move segment to the origin and rotate its chord (or start tangent) to x axis
+    x0, y0 = sp1[1]
+    dx, dy = sp2[1][0]-x0, sp2[1][1]-y0
+    for dx, dy in ((dx, dy), (sp1[2][0]-x0, sp1[2][1]-y0), (sp2[0][0]-x0, sp2[0][1]-y0), (1., 0.)) :
+        l = math.hypot(dx, dy)
+        if l>straight_distance_tolerance : break
+    cos, sin = dx/l, dy/l
+    b = [0., 0.]
+    for x, y in (sp1[2], sp2[0], sp2[1]) :
+        x, y = x-x0, y-y0
+        b += [cos*x + sin*y, cos*y - sin*x]
+    key = (options.biarc_max_split_depth, depth) + tuple(round(v, biarc_cache_precision) for v in b[2:])
+    fit = biarc_cache.get(key)
+    if fit == None :
+        fit = biarc_cache[key] = biarc_fit(b, depth)
+
+    result, start = [], sp1[1]
+    for type_, x, y, cx, cy, a, f1, f2 in fit :
+        end = [x0 + cos*x - sin*y, y0 + sin*x + cos*y]
+        z = [z1+(z2-z1)*f1, z1+(z2-z1)*f2]
+        if type_ == 'line' :
+            result.append( [start, 'line', 0, 0, end, z] )
         else :
-            return  R, alpha
-    R1,a1 = calculate_arc_params(P0,P1,P2)
-    R2,a2 = calculate_arc_params(P2,P3,P4)
-    if R1==None or R2==None or (R1-P0).mag()<straight_tolerance or (R2-P2).mag()<straight_tolerance    : return [ [sp1[1],'line', 0, 0, sp2[1], [z1,z2]] ]
+            result.append( [start, 'arc', [x0 + cos*cx - sin*cy, y0 + sin*cx + cos*cy], a, end, z] )
+        start = end
+    result[-1][4] = sp2[1]
+    return result
 
-    d = csp_to_arc_distance(sp1,sp2, [P0,P2,R1,a1],[P2,P4,R2,a2])
-    if d > 1 and depth<options.biarc_max_split_depth     : return biarc_split(sp1, sp2, z1, z2, depth)
-    else:
-        if R2.mag()*a2 == 0 : zm = z2
-        else : zm  = z1 + (z2-z1)*(abs(R1.mag()*a1))/(abs(R2.mag()*a2)+abs(R1.mag()*a1))
-        return [    [ sp1[1], 'arc', [R1.x,R1.y], a1, [P2.x,P2.y], [z1,zm] ], [ [P2.x,P2.y], 'arc', [R2.x,R2.y], a2, [P4.x,P4.y], [zm,z2] ]        ]
+
+def csp_biarcs(csp) :
+    # Curve of subpaths in their order, each one starts with move and
+    # ends with end
+    c = []
+    for subpath in csp:
+        c += [ [    [subpath[0][1][0],subpath[0][1][1]]   , 'move', 0, 0] ]
+        for i in range(1,len(subpath)):
+            sp1 = [  [subpath[i-1][j][0], subpath[i-1][j][1]] for j in range(3)]
+            sp2 = [  [subpath[i  ][j][0], subpath[i  ][j][1]] for j in range(3)]
+            c += biarc(sp1,sp2,0,0)
+        c += [ [ [subpath[-1][1][0],subpath[-1][1][1]]  ,'end',0,0] ]
+    return c
 
 
 def biarc_curve_segment_length(seg):
@@ -1959,6 +2068,559 @@ def biarc_curve_clip_at_l(curve, l, clip_type = "strict") :
         i = i%len(subcurve)
     return res
 
+################################################################################
+###
+###        Path ordering
+###
+###        Orders subpaths to reduce rapid distance. Nearest neighbour
+###        search uses uniform grid of subpath ends, so ordering takes
+###        O(n) queries instead of O(n^2) scans. Subpaths can be cut in
+###        reverse direction. The order is improved by 2-opt and Or-opt
+###        moves between neighbour ends until the time limit expires.
+###
+###        When subpaths have parents (innermost closed subpath around
+###        them), every subpath is cut before its parent, so parts do not
+###        drop out of the sheet before their holes are cut.
+###
+################################################################################
+class Point_grid:
+    def __init__(self, points, alive=None):
+        # Points are removed lazily, grid is rebuilt when most of them
+        # are gone so empty cells are not searched. Dead points can be
+        # added later, grid extent covers all of them.
+        self.points = points
+        self.alive  = [True]*len(points) if alive==None else alive[:]
+        self.count  = sum(self.alive)
+        self.build()
+
+
+    def build(self) :
+        alive = [i for i in range(len(self.points)) if self.alive[i]]
+        self.built = len(alive)
+        self.cells = {}
+        if self.points == [] : return
+        xs, ys = [p[0] for p in self.points], [p[1] for p in self.points]
+        self.minx, self.miny = min(xs), min(ys)
+        w, h = max(xs)-self.minx, max(ys)-self.miny
+        n = max(len(alive), 1)
+        self.size = max(math.sqrt(w*h/n), max(w,h)/n, 1e-9)
+        self.nx, self.ny = int(w/self.size)+1, int(h/self.size)+1
+        for i in alive :
+            self.cells.setdefault(self.cell(self.points[i]), []).append(i)
+
+
+    def add(self, i) :
+        if not self.alive[i] :
+            self.alive[i] = True
+            self.count += 1
+            self.cells.setdefault(self.cell(self.points[i]), []).append(i)
+
+
+    def cell(self, p) :
+        return int((p[0]-self.minx)/self.size), int((p[1]-self.miny)/self.size)
+
+
+    def remove(self, i) :
+        if self.alive[i] :
+            self.alive[i] = False
+            self.count -= 1
+            if self.count*4 < self.built : self.build()
+
+
+    def nearest(self, p, k=1) :
+        # Returns up to k nearest alive points as [[distance^2, i],...]
+        if self.count == 0 : return []
+        # Cell of point outside of grid is clamped to the nearest one
+        cx, cy = self.cell(p)
+        cx, cy = min(max(cx, 0), self.nx-1), min(max(cy, 0), self.ny-1)
+        best = []
+        r = 0
+        while True :
+            for x in range(cx-r, cx+r+1) :
+                for y in ([cy-r, cy+r] if abs(x-cx)<r else range(cy-r, cy+r+1)) :
+                    for i in self.cells.get((x,y), ()) :
+                        if self.alive[i] :
+                            q = self.points[i]
+                            best.append([(q[0]-p[0])**2+(q[1]-p[1])**2, i])
+            if len(best) >= k :
+                best.sort()
+                del best[k:]
+                # Points of further rings are at least r cells away
+                if best[-1][0] <= (r*self.size)**2 : return best
+            if cx-r<0 and cy-r<0 and cx+r>=self.nx and cy+r>=self.ny :
+                best.sort()
+                return best[:k]
+            r += 1
+
+
+def csp_subpaths_bounds(csp) :
+    # Returns [minx,miny,maxx,maxy] of each subpath, all segments are
+    # bounded in one batch
+    b, index = laser_bezier.csp_to_segments(csp)
+    bounds = [[sp[0][1][0], sp[0][1][1], sp[0][1][0], sp[0][1][1]] for sp in csp]
+    if len(b) == 0 : return bounds
+    low, high = laser_bezier.bounds(b)[:2]
+    first = numpy.array([k for k in range(len(index)) if index[k][1] == 1])
+    subpaths = [index[k][0] for k in first]
+    for i, l, h in zip(subpaths, numpy.minimum.reduceat(low, first).tolist(), numpy.maximum.reduceat(high, first).tolist()) :
+        bounds[i] = l + h
+    return bounds
+
+
+def csp_subpaths_containment(csp) :
+    # Returns parent of each subpath - the innermost closed subpath
+    # containing its first point, or None. Closed subpaths are flattened
+    # to polygons, candidates come from Csp_grid of their bounds.
+    n = len(csp)
+    bounds = csp_subpaths_bounds(csp)
+    closed = [k for k in range(n) if len(csp[k])>2 and csp_subpaths_end_to_start_distance2(csp[k],csp[k]) < 0.001]
+    parents = [None]*n
+    if closed == [] : return parents
+    area = lambda k : (bounds[k][2]-bounds[k][0])*(bounds[k][3]-bounds[k][1])
+    closed.sort(key=area)
+    grid = Csp_grid([csp[k] for k in closed], subpaths=True)
+    polygons = {}
+    for k in range(n) :
+        p = csp[k][0][1]
+        b = bounds[k]
+        for c in grid.near([p[0], p[1], p[0], p[1]]) :
+            c = closed[c]
+            # Candidates are sorted by area, the first one containing
+            # the subpath is its parent. Equal subpaths nest by index.
+            if c == k or area(c) < area(k) or area(c) == area(k) and c < k : continue
+            if not (bounds[c][0]<=b[0] and bounds[c][1]<=b[1] and b[2]<=bounds[c][2] and b[3]<=bounds[c][3]) : continue
+            if c not in polygons :
+                segments = laser_bezier.csp_to_segments([csp[c]])[0]
+                polygons[c] = Polygon([ laser_bezier.at(segments, numpy.broadcast_to(numpy.arange(8)/8., (len(segments),8))).reshape(-1,2).tolist() ])
+            if polygons[c].point_inside(p[:]) :
+                parents[k] = c
+                break
+    return parents
+
+
+def csp_subpaths_order(ends, start=[0.,0.], parents=None) :
+    # ends[k] = [start point, end point] of k-th subpath. Returns list
+    # of [k, reversed] pairs starting nearest to start point. Subpath
+    # becomes available when all of its children are cut.
+    n = len(ends)
+    if n == 0 : return []
+    pending = [0]*n
+    if parents != None :
+        for k in range(n) :
+            if parents[k] != None : pending[parents[k]] += 1
+    grid = Point_grid([ends[k][e] for k in range(n) for e in (0,1)], [pending[k]==0 for k in range(n) for e in (0,1)])
+    order, p = [], start
+    for i in range(n) :
+        j = grid.nearest(p)[0][1]
+        k, reverse = j//2, j%2==1
+        grid.remove(2*k)
+        grid.remove(2*k+1)
+        order.append([k, reverse])
+        p = ends[k][0 if reverse else 1]
+        if parents != None and parents[k] != None :
+            pending[parents[k]] -= 1
+            if pending[parents[k]] == 0 :
+                grid.add(2*parents[k])
+                grid.add(2*parents[k]+1)
+    return order
+
+
+def csp_subpaths_rapid_distance(ends, order, start=[0.,0.]) :
+    l, p = 0., start
+    for k, reverse in order :
+        s = ends[k][1 if reverse else 0]
+        l += math.hypot(s[0]-p[0], s[1]-p[1])
+        p = ends[k][0 if reverse else 1]
+    return l
+
+
+def csp_subpaths_order_improve(ends, order, start, time_limit, parents=None, neighbours=8) :
+    # Local search over open tour from start point. 2-opt reverses run
+    # of subpaths (each of them is cut reversed then), Or-opt moves run
+    # of up to 3 subpaths elsewhere. Only moves creating a rapid between
+    # neighbour ends are tried, moves cutting parent before its child
+    # are undone.
+    deadline = time.time() + time_limit
+    n = len(order)
+    points = [ends[k][e] for k in range(n) for e in (0,1)]
+    grid = Point_grid(points)
+    near = [[j for d,j in grid.nearest(p, neighbours+2) if j//2 != i//2][:neighbours] for i,p in enumerate(points)]
+    near_start = [j for d,j in grid.nearest(start, neighbours)]
+    order = [o[:] for o in order]
+    pos = [0]*n
+    for i in range(n) : pos[order[i][0]] = i
+
+    def sid(i) : return 2*order[i][0] + (1 if order[i][1] else 0)
+    def eid(i) : return 2*order[i][0] + (0 if order[i][1] else 1)
+    def S(i) : return points[sid(i)] if i<n else None
+    def E(i) : return points[eid(i)] if i>=0 else start
+    def d(a, b) : return 0. if a is None or b is None else math.hypot(a[0]-b[0], a[1]-b[1])
+    def update(a, b) :
+        for i in range(a, b) : pos[order[i][0]] = i
+    children = [[] for k in range(n)]
+    if parents != None :
+        for k in range(n) :
+            if parents[k] != None : children[parents[k]].append(k)
+    def valid(a, b) :
+        if parents == None : return True
+        for i in range(a, b) :
+            k = order[i][0]
+            if parents[k] != None and pos[parents[k]] < i : return False
+            for c in children[k] :
+                if pos[c] > i : return False
+        return True
+    def apply(a, b, run) :
+        old = order[a:b]
+        order[a:b] = run
+        update(a, b)
+        if valid(a, b) : return True
+        order[a:b] = old
+        update(a, b)
+        return False
+
+    def two_opt(i) :
+        # New rapids E(i-1) -> E(j) and S(i) -> S(j+1)
+        js = set([n-1])
+        for q in (near[eid(i-1)] if i>0 else near_start) :
+            if pos[q//2]>=i and q == eid(pos[q//2]) : js.add(pos[q//2])
+        for q in near[sid(i)] :
+            if pos[q//2]>i and q == sid(pos[q//2]) : js.add(pos[q//2]-1)
+        for j in js :
+            if d(E(i-1),E(j)) + d(S(i),S(j+1)) - d(E(i-1),S(i)) - d(E(j),S(j+1)) < -1e-9 :
+                if apply(i, j+1, [[k, not r] for k,r in order[i:j+1][::-1]]) : return True
+        return False
+
+    def or_opt(i, l) :
+        # Run i..i+l-1 goes between p and p+1, forward or reversed
+        gain = d(E(i-1),S(i)) + d(E(i+l-1),S(i+l)) - d(E(i-1),S(i+l))
+        ps = set()
+        for q in near[sid(i)] + near[eid(i+l-1)] :
+            p = pos[q//2]
+            ps.update([p, p-1])
+        for p in ps :
+            if i-1 <= p <= i+l-1 : continue
+            forward  = d(E(p),S(i)) + d(E(i+l-1),S(p+1)) - d(E(p),S(p+1))
+            backward = d(E(p),E(i+l-1)) + d(S(i),S(p+1)) - d(E(p),S(p+1))
+            if min(forward, backward) - gain < -1e-9 :
+                run = order[i:i+l] if forward <= backward else [[k, not r] for k,r in order[i:i+l][::-1]]
+                if p < i :
+                    if apply(p+1, i+l, run + order[p+1:i]) : return True
+                else :
+                    if apply(i, p+1, order[i+l:p+1] + run) : return True
+        return False
+
+    improved = True
+    while improved and time.time() < deadline :
+        improved = False
+        for i in range(n) :
+            if time.time() > deadline : break
+            if two_opt(i) :
+                improved = True
+            for l in range(1, 4) :
+                if i+l <= n and or_opt(i, l) :
+                    improved = True
+                    break
+    return order
+
+
+def csp_subpaths_sort(csp) :
+    # Order of subpaths by options (inside out, improvement time limit).
+    # Returns keys [[k,reverse],...] and rapid distances in document
+    # order, nearest neighbour order and improved order.
+    ends = [ [subpath[0][1], subpath[-1][1]] for subpath in csp ]
+    parents = csp_subpaths_containment(csp) if options.inside_out else None
+    keys = csp_subpaths_order(ends, [0.,0.], parents)
+    nearest = csp_subpaths_rapid_distance(ends, keys)
+    if options.path_order_time > 0 and len(keys) > 2 :
+        keys = csp_subpaths_order_improve(ends, keys, [0.,0.], options.path_order_time, parents)
+    return keys, (csp_subpaths_rapid_distance(ends, [[k,False] for k in range(len(csp))]), nearest, csp_subpaths_rapid_distance(ends, keys))
+
+
+################################################################################
+###
+###        Spatial index
+###
+###        Uniform grid over segments of csp (or its whole subpaths), built
+###        once and queried for segments which might intersect or lie within
+###        given distance, instead of testing all pairs.
+###
+################################################################################
+class Csp_grid:
+    def __init__(self, csp, size=None, subpaths=False) :
+        # Segments of csp (or whole subpaths when subpaths is True) are
+        # stored in every cell covered by bounds of their control points,
+        # the curve always lies within them. index holds [i,j] of each
+        # segment or [i] of each subpath. Polylines are csp with all
+        # control points at their nodes.
+        self.segments, self.index = laser_bezier.csp_to_segments(csp)
+        self.bounds = laser_bezier.control_bounds(self.segments)
+        if subpaths and len(self.segments) :
+            first = numpy.array([k for k in range(len(self.index)) if self.index[k][1] == 1])
+            self.index = [self.index[k][:1] for k in first]
+            self.ranges = list(zip(first.tolist(), first[1:].tolist()+[len(self.segments)]))
+            self.bounds = numpy.concatenate((numpy.minimum.reduceat(self.bounds[:,:2], first), numpy.maximum.reduceat(self.bounds[:,2:], first)), axis=1)
+        self.cells = {}
+        n = len(self.bounds)
+        if n == 0 : return
+        self.minx, self.miny = self.bounds[:,0].min(), self.bounds[:,1].min()
+        w, h = self.bounds[:,2].max()-self.minx, self.bounds[:,3].max()-self.miny
+        if size == None :
+            size = numpy.maximum(self.bounds[:,2]-self.bounds[:,0], self.bounds[:,3]-self.bounds[:,1]).mean()*2
+        self.size = max(size, w/n, h/n, 1e-9)
+        self.nx, self.ny = int(w/self.size)+1, int(h/self.size)+1
+        cells = ((self.bounds-[self.minx, self.miny, self.minx, self.miny])/self.size).astype(int).tolist()
+        for k, (x1,y1,x2,y2) in enumerate(cells) :
+            for x in range(x1, x2+1) :
+                for y in range(y1, y2+1) :
+                    self.cells.setdefault((x,y), []).append(k)
+
+
+    def near(self, bound, d=0.) :
+        # Returns sorted numbers of segments which bounds are within d of
+        # bound [minx,miny,maxx,maxy]
+        if not self.cells : return []
+        x1, y1 = int(math.floor((bound[0]-d-self.minx)/self.size)), int(math.floor((bound[1]-d-self.miny)/self.size))
+        x2, y2 = int(math.floor((bound[2]+d-self.minx)/self.size)), int(math.floor((bound[3]+d-self.miny)/self.size))
+        found = set()
+        for x in range(max(x1, 0), min(x2, self.nx-1)+1) :
+            for y in range(max(y1, 0), min(y2, self.ny-1)+1) :
+                found.update(self.cells.get((x,y), ()))
+        if not found : return []
+        k = numpy.array(sorted(found))
+        b = self.bounds[k]
+        dx = numpy.maximum(0, numpy.maximum(b[:,0]-bound[2], bound[0]-b[:,2]))
+        dy = numpy.maximum(0, numpy.maximum(b[:,1]-bound[3], bound[1]-b[:,3]))
+        return k[dx*dx+dy*dy <= d*d].tolist()
+
+
+    def pairs(self) :
+        # Returns array of pairs [k1,k2], k1<k2, of segments which bounds
+        # overlap - candidates for intersections
+        found = set()
+        for cell in self.cells.values() :
+            for a in range(len(cell)) :
+                k1 = cell[a]
+                for k2 in cell[a+1:] :
+                    found.add((k1, k2))
+        if not found : return numpy.zeros((0,2), dtype=int)
+        k = numpy.array(sorted(found))
+        b1, b2 = self.bounds[k[:,0]], self.bounds[k[:,1]]
+        return k[(b1[:,0]<=b2[:,2]) & (b2[:,0]<=b1[:,2]) & (b1[:,1]<=b2[:,3]) & (b2[:,1]<=b1[:,3])]
+
+
+    def distance2(self, points, r) :
+        # Returns squared distances from points to the nearest chords of
+        # segments (exact for polylines), distances over r are returned
+        # as r^2. Points are processed in groups sharing the grid cell.
+        points = numpy.asarray(points, dtype=float).reshape(-1,2)
+        result = numpy.full(len(points), r*r)
+        if not self.cells or len(points) == 0 : return result
+        groups = {}
+        for i, c in enumerate(numpy.floor((points-[self.minx, self.miny])/self.size).astype(int).tolist()) :
+            groups.setdefault(tuple(c), []).append(i)
+        k = int(r/self.size)+1
+        start, chord = self.segments[:,0], self.segments[:,3]-self.segments[:,0]
+        for (cx, cy), group in groups.items() :
+            near = set()
+            for x in range(cx-k, cx+k+1) :
+                for y in range(cy-k, cy+k+1) :
+                    near.update(self.cells.get((x,y), ()))
+            if not near : continue
+            near = list(near)
+            s, d = start[near], chord[near]
+            p = points[group][:,None,:]
+            l = (d*d).sum(-1)
+            t = numpy.clip(((p-s)*d).sum(-1)/numpy.where(l>0, l, 1), 0, 1)[...,None]
+            result[group] = numpy.minimum(r*r, ((s+t*d-p)**2).sum(-1).min(1))
+        return result
+
+
+    def winding(self, points) :
+        # Returns winding numbers of points around closed subpaths (by
+        # chords of their segments), the grid has to be built of subpaths.
+        # Only subpaths which bounds contain the point are tested.
+        points = numpy.asarray(points, dtype=float).reshape(-1,2)
+        result = numpy.zeros(len(points), dtype=int)
+        if not self.cells or len(points) == 0 : return result
+        groups = {}
+        for i, c in enumerate(numpy.floor((points-[self.minx, self.miny])/self.size).astype(int).tolist()) :
+            groups.setdefault(tuple(c), []).append(i)
+        for c, group in groups.items() :
+            for k in self.cells.get(c, ()) :
+                b, p = self.bounds[k], points[group]
+                inside = (b[0]<=p[:,0]) & (p[:,0]<=b[2]) & (b[1]<=p[:,1]) & (p[:,1]<=b[3])
+                if not inside.any() : continue
+                s = self.segments[self.ranges[k][0]:self.ranges[k][1]]
+                a, e = s[:,0], s[:,3]
+                x, y = p[inside][:,0,None], p[inside][:,1,None]
+                cross = (e[:,0]-a[:,0])*(y-a[:,1]) - (e[:,1]-a[:,1])*(x-a[:,0])
+                up = (a[:,1]<=y) & (y<e[:,1]) & (cross>0)
+                down = (e[:,1]<=y) & (y<a[:,1]) & (cross<0)
+                result[numpy.array(group)[inside]] += up.sum(1) - down.sum(1)
+        return result
+
+
+################################################################################
+###
+###        Kerf compensation
+###
+###        Closed subpaths are flattened to polygons and offset away from
+###        the material by half of the kerf. Raw offsets are split at their
+###        intersections (found through Csp_grid of their segments), parts
+###        closer to the original polygons than the offset are dropped and
+###        the rest is chained back into closed contours.
+###
+################################################################################
+def csp_flatten_subpath(subpath, tolerance) :
+    # Returns polygon of the closed subpath as numpy array of points
+    # (without closing point), deviation is kept within tolerance.
+    points = laser_bezier.flatten(laser_bezier.csp_to_segments([subpath])[0], tolerance)
+    keep = numpy.hypot(*(points - numpy.roll(points, 1, 0)).T) > straight_distance_tolerance
+    return points[keep]
+
+
+def polygon_offset(points, s, tolerance) :
+    # Raw offset of closed polygon by s to the right of its direction. Outer
+    # corners are joined by lines tangent to the arc around the vertex, so
+    # no point of the offset is closer than |s| to the polygon. Inner
+    # corners are joined through the vertex itself and are clipped later.
+    e = numpy.roll(points, -1, 0) - points
+    e /= numpy.hypot(e[:,0], e[:,1])[:,None]
+    normals = numpy.column_stack((e[:,1], -e[:,0]))
+    r = abs(s)
+    step = 2*math.acos(1-tolerance/r) if tolerance < r else math.pi/2
+    result = []
+    for i, (p, n1, n2, e1, e2) in enumerate(zip(points.tolist(), numpy.roll(normals, 1, 0).tolist(), normals.tolist(), numpy.roll(e, 1, 0).tolist(), e.tolist())) :
+        cross, dot = e1[0]*e2[1]-e1[1]*e2[0], e1[0]*e2[0]+e1[1]*e2[1]
+        result.append( (p[0]+n1[0]*s, p[1]+n1[1]*s) )
+        if cross*s > 0 :
+            # Offset side is outer side of the corner
+            a1 = math.atan2(n1[1]*s, n1[0]*s)
+            sweep = math.atan2(cross, dot)
+            k = int(math.ceil(abs(sweep)/step))
+            h = sweep/k
+            for j in range(k) :
+                a = a1 + (j+.5)*h
+                result.append( (p[0]+math.cos(a)*r/math.cos(h/2), p[1]+math.sin(a)*r/math.cos(h/2)) )
+        elif cross*s < 0 or dot < 0 :
+            result.append( (p[0], p[1]) )
+        result.append( (p[0]+n2[0]*s, p[1]+n2[1]*s) )
+    return result
+
+
+def csp_kerf_offset(csp, r, tolerance=0.01) :
+    # Offsets closed subpaths by r away from the material (outer contours
+    # grow, holes shrink), material is even-odd fill of closed subpaths.
+    # Offsets of parts closer than 2r merge into one contour. Open
+    # subpaths are returned unchanged. Result subpaths are polylines.
+    parents = csp_subpaths_containment(csp)
+    closed = [k for k in range(len(csp)) if len(csp[k])>2 and csp_subpaths_end_to_start_distance2(csp[k],csp[k]) < 0.001]
+    result = [csp[k] for k in sorted(set(range(len(csp)))-set(closed))]
+    polygons, raw = [], []
+    for k in closed :
+        points = csp_flatten_subpath(csp[k], tolerance)
+        if len(points) < 3 : continue
+        depth, c = 0, parents[k]
+        while c != None :
+            depth, c = depth+1, parents[c]
+        # Outer contours go counterclockwise and holes clockwise, so the
+        # material is always on the left and the offset on the right
+        x, y = points[:,0], points[:,1]
+        area = (x*numpy.roll(y, -1) - numpy.roll(x, -1)*y).sum()
+        if (area>0) != (depth%2==0) :
+            points = points[::-1]
+        polygons.append(points)
+        raw.append(polygon_offset(points, r, tolerance))
+    if raw == [] : return result
+
+    # Split raw offsets at their intersections, candidates are pairs of
+    # segments with overlapping bounds. Crossings near segment ends are
+    # snapped to the end points and collinear segments are split at ends
+    # of each other, so pieces of different offsets share end points.
+    raw = [[p for p, q in zip(loop, loop[1:]+loop[:1]) if p != q] for loop in raw]
+    raw = [loop for loop in raw if len(loop) > 1]
+    offsets = [[[p,p,p] for p in loop+loop[:1]] for loop in raw]
+    grid = Csp_grid(offsets)
+    segments = [(raw[i][j-1], raw[i][j%len(raw[i])]) for i, j in grid.index]
+    splits = [[] for s in segments]
+    k1, k2 = grid.pairs().T
+    a1, d1 = grid.segments[k1,0], grid.segments[k1,3]-grid.segments[k1,0]
+    a2, d2 = grid.segments[k2,0], grid.segments[k2,3]-grid.segments[k2,0]
+    l1, l2 = numpy.hypot(d1[:,0], d1[:,1]), numpy.hypot(d2[:,0], d2[:,1])
+    d = d1[:,0]*d2[:,1] - d1[:,1]*d2[:,0]
+    eps = 1e-9
+    parallel = abs(d) <= eps*l1*l2
+    with numpy.errstate(divide='ignore', invalid='ignore') :
+        t1 = ((a2-a1)[:,0]*d2[:,1] - (a2-a1)[:,1]*d2[:,0])/d
+        t2 = ((a2-a1)[:,0]*d1[:,1] - (a2-a1)[:,1]*d1[:,0])/d
+    crossing = ~parallel & (-eps<=t1) & (t1<=1+eps) & (-eps<=t2) & (t2<=1+eps)
+    for i, j, ti, tj in zip(k1[crossing].tolist(), k2[crossing].tolist(), t1[crossing].tolist(), t2[crossing].tolist()) :
+        (a, b), (c, e) = segments[i], segments[j]
+        if ti < eps : p = a
+        elif ti > 1-eps : p = b
+        elif tj < eps : p = c
+        elif tj > 1-eps : p = e
+        else : p = (a[0]+(b[0]-a[0])*ti, a[1]+(b[1]-a[1])*ti)
+        if eps < ti < 1-eps : splits[i].append((ti, p))
+        if eps < tj < 1-eps : splits[j].append((tj, p))
+    collinear = parallel & (abs((a2-a1)[:,0]*d1[:,1] - (a2-a1)[:,1]*d1[:,0]) <= eps*l1)
+    for i, j in zip(k1[collinear].tolist(), k2[collinear].tolist()) :
+        for i, j in ((i, j), (j, i)) :
+            a, b = segments[i]
+            l = (b[0]-a[0])**2 + (b[1]-a[1])**2
+            for p in segments[j] :
+                t = ((p[0]-a[0])*(b[0]-a[0]) + (p[1]-a[1])*(b[1]-a[1]))/l
+                if eps < t < 1-eps : splits[i].append((t, p))
+    pieces = {}
+    for (a, b), split in zip(segments, splits) :
+        points = [a] + [p for t, p in sorted(split)] + [b]
+        for piece in zip(points, points[1:]) :
+            pieces[piece] = True
+    # Overlapping pieces of the same direction are kept once, of opposite
+    # directions they cancel each other
+    pieces = [(a, b) for a, b in pieces if a != b and (b, a) not in pieces]
+
+    # Keep pieces on the outline of the union of raw offsets - outside of
+    # all of them on their right side. Raw offsets go around the material
+    # (holes clockwise), so winding number there is zero. Pieces closer
+    # to the polygons than r (loops at inner corners) are dropped too.
+    middles = numpy.array([((a[0]+b[0])/2, (a[1]+b[1])/2) for a, b in pieces])
+    normals = numpy.array([(b[1]-a[1], a[0]-b[0]) for a, b in pieces])
+    normals *= r*1e-6/numpy.hypot(normals[:,0], normals[:,1])[:,None]
+    original = Csp_grid([[[p,p,p] for p in polygon.tolist()+polygon[:1].tolist()] for polygon in polygons])
+    limit = (r*(1-1e-6))**2
+    keep = (original.distance2(middles, r) >= limit) & (Csp_grid(offsets, subpaths=True).winding(middles+normals) <= 0)
+    pieces = [pieces[i] for i in numpy.nonzero(keep)[0]]
+
+    # Drop dangling pieces and chain the rest into closed contours
+    outgoing, ending = {}, {}
+    for i, (a, b) in enumerate(pieces) :
+        outgoing.setdefault(a, []).append(i)
+        ending.setdefault(b, []).append(i)
+    alive = [True]*len(pieces)
+    stack = list(range(len(pieces)))
+    while stack :
+        i = stack.pop()
+        if not alive[i] : continue
+        a, b = pieces[i]
+        if any(alive[j] for j in outgoing.get(b, ())) and any(alive[j] for j in ending.get(a, ())) : continue
+        alive[i] = False
+        stack += ending.get(a, []) + outgoing.get(b, [])
+    for i in range(len(pieces)) :
+        if not alive[i] : continue
+        a, b = pieces[i]
+        loop, alive[i] = [a], False
+        while b != a :
+            loop.append(b)
+            following = [j for j in outgoing.get(b, []) if alive[j]]
+            if following == [] : break
+            alive[following[0]] = False
+            b = pieces[following[0]][1]
+        if b == a and len(loop) > 2 :
+            result.append([[list(p), list(p), list(p)] for p in loop + [a]])
+    return result
+
+
 ################################################################################
 ###        Polygon class
 ################################################################################
@@ -2434,6 +3096,53 @@ class Arangement_Genetic:
         #surface.draw()
 
 
+################################################################################
+###
+###        Parallel processing
+###
+###        Layers are ordered in worker processes, then runs of ordered
+###        subpaths are fitted by biarcs and converted to Gcode there. Each
+###        worker has its own extension instance (options.self) with options
+###        and tools of the main one. Results come back in order of tasks,
+###        so Gcode does not depend on the number of workers.
+###
+################################################################################
+
+def parallel_options(options_) :
+    # Copy of options which can be sent to workers, svg stays in the main process
+    values = copy.copy(options_)
+    values.self = values.doc_root = None
+    return values
+
+
+def parallel_init(options_, tools) :
+    global options, print_
+    options = options_
+    if not options.log_create_log :
+        print_ = lambda *x : None
+    options.self = laser_gcode()
+    options.self.options = options
+    options.self.tools = tools
+
+
+def parallel_layer_order(p) :
+    # Kerf offset and order of transformed layer subpaths. Returns the
+    # subpaths in cutting order, reversed ones reversed already, and the
+    # rapid distances.
+    if len(p) == 0 : return [], None
+    if options.kerf > 0 :
+        p = csp_kerf_offset(p, options.kerf/2)
+    keys, distances = csp_subpaths_sort(p)
+    return [csp_reverse([p[k]])[0] if reverse else p[k] for k, reverse in keys], distances
+
+
+def parallel_gcode(p) :
+    # Curve of ordered subpaths and its Gcode. Every subpath starts with
+    # move, so Gcode of consecutive runs of subpaths can be concatenated.
+    curve = csp_biarcs(p)
+    return curve, options.self.generate_gcode(curve, None, 0)
+
+
 ################################################################################
 ###
 ###        Gcodetools class
@@ -2443,11 +3152,23 @@ class Arangement_Genetic:
 class laser_gcode(inkex.Effect):
 
     def export_gcode(self,gcode):
-        gcode_pass = gcode
-        for x in range(1,self.options.passes):
-            gcode += "G91\nG1 Z-" + self.options.pass_depth + "\nG90\n" + gcode_pass
-        f = open(self.options.directory+self.options.file, "w")
-        f.write(self.options.laser_off_command + " S0" + "\n" + self.header + "G1 F" + self.options.travel_speed + "\n" + gcode + self.footer)
+        # gcode is a list of program chunks, every pass writes the same
+        # chunks again instead of concatenating the program per pass
+        f = open(self.options.directory+self.options.file, "w", gcode_write_buffer)
+        f.write(self.options.laser_off_command + " S0" + "\n" + self.header + "G1 F" + self.options.travel_speed + "\n")
+        step = "G91\nG1 Z-" + self.options.pass_depth + "\nG90\n"
+        if self.options.repeat_marker and self.options.passes > 1 :
+            # Program is written once and repeated by firmware (M808 of Marlin 2.0.8+).
+            # Head is lifted by one pass depth first, so that each loop starts with the step down.
+            f.write("G91\nG1 Z" + self.options.pass_depth + "\nG90\n" + "M808 L%d\n" % self.options.passes + step)
+            f.writelines(gcode)
+            f.write("M808\n")
+        else :
+            for x in range(self.options.passes):
+                if x > 0 :
+                    f.write(step)
+                f.writelines(gcode)
+        f.write(self.footer)
         f.close()
 
     def __init__(self):
@@ -2470,42 +3191,12 @@ class laser_gcode(inkex.Effect):
         self.OptionParser.add_option("",   "--unit",                            action="store", type="string",          dest="unit",                                default="G21 (All units in mm)",        help="Units either mm or inches")
         self.OptionParser.add_option("",   "--active-tab",                      action="store", type="string",          dest="active_tab",                          default="",                             help="Defines which tab is active")
         self.OptionParser.add_option("",   "--biarc-max-split-depth",           action="store", type="int",             dest="biarc_max_split_depth",               default="4",                            help="Defines maximum depth of splitting while approximating using biarcs.")
-
-    def parse_curve(self, p, layer, w = None, f = None):
-            c = []
-            if len(p)==0 :
-                return []
-            p = self.transform_csp(p, layer)
-
-
-            ### Sort to reduce Rapid distance
-            k = list(range(1,len(p)))
-            keys = [0]
-            while len(k)>0:
-                end = p[keys[-1]][-1][1]
-                dist = None
-                for i in range(len(k)):
-                    start = p[k[i]][0][1]
-                    n     = ( -( ( end[0]-start[0])**2+(end[1]-start[1])**2 ) ,i)
-                    if dist is None:
-                        dist = n
-                    else:
-                        dist = max(n, dist)
-                keys += [k[dist[1]]]
-                del k[dist[1]]
-            for k in keys:
-                subpath = p[k]
-                c += [ [    [subpath[0][1][0],subpath[0][1][1]]   , 'move', 0, 0] ]
-                for i in range(1,len(subpath)):
-                    sp1 = [  [subpath[i-1][j][0], subpath[i-1][j][1]] for j in range(3)]
-                    sp2 = [  [subpath[i  ][j][0], subpath[i  ][j][1]] for j in range(3)]
-                    c += biarc(sp1,sp2,0,0) if w==None else biarc(sp1,sp2,-f(w[k][i-1]),-f(w[k][i]))
-#                    l1 = biarc(sp1,sp2,0,0) if w==None else biarc(sp1,sp2,-f(w[k][i-1]),-f(w[k][i]))
-#                    print_((-f(w[k][i-1]),-f(w[k][i]), [i1[5] for i1 in l1]) )
-                c += [ [ [subpath[-1][1][0],subpath[-1][1][1]]  ,'end',0,0] ]
-                print_("Curve: " + str(c))
-            return c
-
+        self.OptionParser.add_option("",   "--path-order-time",                 action="store", type="float",           dest="path_order_time",                     default="1",                            help="Time limit of path order improvement (s)")
+        self.OptionParser.add_option("",   "--inside-out",                      action="store", type="inkbool",         dest="inside_out",                          default=True,                           help="Cut inner contours before contours around them")
+        self.OptionParser.add_option("",   "--repeat-marker",                   action="store", type="inkbool",         dest="repeat_marker",                       default=False,                          help="Repeat passes with M808 loop instead of writing the program once per pass")
+        self.OptionParser.add_option("",   "--kerf",                            action="store", type="float",           dest="kerf",                                default="0",                            help="Kerf width, closed paths are offset by half of it away from the material")
+        self.OptionParser.add_option("",   "--jobs",                            action="store", type="int",             dest="jobs",                                default="0",                            help="Count of worker processes (0 - count of CPUs, 1 - no workers)")
+        self.OptionParser.add_option("",   "--parallel-min-segments",           action="store", type="int",             dest="parallel_min_segments",               default="4000",                         help="Smallest count of segments exported by worker processes")
 
     def draw_curve(self, curve, layer, group=None, style=styles["biarc_style"]):
 
@@ -2681,7 +3372,7 @@ class laser_gcode(inkex.Effect):
             self.last_used_tool = None
         print_("working on curve")
         print_("Curve: " + str(curve))
-        g = ""
+        g = []
 
         lg, f =  'G00', "F%f"%tool['penetration feed']
         penetration_feed = "F%s"%tool['penetration feed']
@@ -2691,55 +3382,64 @@ class laser_gcode(inkex.Effect):
             s, si = curve[i-1], curve[i]
             feed = f if lg not in ['G01','G02','G03'] else ''
             if s[1]    == 'move':
-                g += "G1 " + c(si[0]) + "\n" + tool['gcode before path'] + "\n"
+                g.append("G1 " + c(si[0]) + "\n" + tool['gcode before path'] + "\n")
                 lg = 'G00'
             elif s[1] == 'end':
-                g += tool['gcode after path'] + "\n"
+                g.append(tool['gcode after path'] + "\n")
                 lg = 'G00'
             elif s[1] == 'line':
-                if lg=="G00": g += "G1 " + feed + "\n"
-                g += "G1 " + c(si[0]) + "\n"
+                if lg=="G00": g.append("G1 " + feed + "\n")
+                g.append("G1 " + c(si[0]) + "\n")
                 lg = 'G01'
             elif s[1] == 'arc':
                 r = [(s[2][0]-s[0][0]), (s[2][1]-s[0][1])]
-                if lg=="G00": g += "G1 " + feed + "\n"
+                if lg=="G00": g.append("G1 " + feed + "\n")
                 if (r[0]**2 + r[1]**2)>.1:
                     r1, r2 = (P(s[0])-P(s[2])), (P(si[0])-P(s[2]))
                     if abs(r1.mag()-r2.mag()) < 0.001 :
-                        g += ("G2" if s[3]<0 else "G3") + c(si[0]+[ None, (s[2][0]-s[0][0]),(s[2][1]-s[0][1])  ]) + "\n"
+                        g.append(("G2" if s[3]<0 else "G3") + c(si[0]+[ None, (s[2][0]-s[0][0]),(s[2][1]-s[0][1])  ]) + "\n")
                     else:
                         r = (r1.mag()+r2.mag())/2
-                        g += ("G2" if s[3]<0 else "G3") + c(si[0]) + " R%f" % (r) + "\n"
+                        g.append(("G2" if s[3]<0 else "G3") + c(si[0]) + " R%f" % (r) + "\n")
                     lg = 'G02'
                 else:
-                    g += "G1 " + c(si[0]) + " " + feed + "\n"
+                    g.append("G1 " + c(si[0]) + " " + feed + "\n")
                     lg = 'G01'
         if si[1] == 'end':
-            g += tool['gcode after path'] + "\n"
-        return g
+            g.append(tool['gcode after path'] + "\n")
+        return "".join(g)
 
 
     def get_transforms(self,g):
+        # Transform is composed once per element, children reuse the
+        # transform of their parent
         root = self.document.getroot()
-        trans = []
-        while (g!=root):
+        if g == root : return []
+        if g not in self.transforms :
+            trans = self.get_transforms(g.getparent())
             if 'transform' in list(g.keys()):
                 t = g.get('transform')
                 t = simpletransform.parseTransform(t)
-                trans = simpletransform.composeTransform(t,trans) if trans != [] else t
+                trans = simpletransform.composeTransform(trans,t) if trans != [] else t
                 print_(trans)
-            g=g.getparent()
-        return trans
+            self.transforms[g] = trans
+        return self.transforms[g]
 
 
     def apply_transforms(self,g,csp):
         trans = self.get_transforms(g)
         if trans != []:
-            simpletransform.applyTransformToPath(trans, csp)
+            csp = csp_transform(csp, trans)
         return csp
 
 
     def transform(self, source_point, layer, reverse=False):
+        t = self.get_transform_matrix(layer, reverse)
+        x,y = source_point[0], source_point[1]
+        return [t[0][0]*x+t[0][1]*y+t[0][2], t[1][0]*x+t[1][1]*y+t[1][2]]
+
+
+    def get_transform_matrix(self, layer, reverse=False):
         if layer == None :
             layer = self.current_layer if self.current_layer is not None else self.document.getroot()
         if layer not in self.transform_matrix:
@@ -2802,21 +3502,14 @@ class laser_gcode(inkex.Effect):
             self.Zauto_scale[layer] = 1
             print_("Z automatic scale = %s (computed according orientation points)" % self.Zauto_scale[layer])
 
-        x,y = source_point[0], source_point[1]
         if not reverse :
-            t = self.transform_matrix[layer]
+            return self.transform_matrix[layer]
         else :
-            t = self.transform_matrix_reverse[layer]
-        return [t[0][0]*x+t[0][1]*y+t[0][2], t[1][0]*x+t[1][1]*y+t[1][2]]
+            return self.transform_matrix_reverse[layer]
 
 
     def transform_csp(self, csp_, layer, reverse = False):
-        csp = [  [ [csp_[i][j][0][:],csp_[i][j][1][:],csp_[i][j][2][:]]  for j in range(len(csp_[i])) ]   for i in range(len(csp_)) ]
-        for i in range(len(csp)):
-            for j in range(len(csp[i])):
-                for k in range(len(csp[i][j])):
-                    csp[i][j][k] = self.transform(csp[i][j][k],layer, reverse)
-        return csp
+        return csp_transform(csp_, self.get_transform_matrix(layer, reverse))
 
 
 ################################################################################
@@ -2827,7 +3520,10 @@ class laser_gcode(inkex.Effect):
 ###        sepparated strings (case is ignoreg).
 ################################################################################
     def error(self, s, type_= "Warning"):
-        notes = "Note "
+        notes = """
+                        Note
+                        rapid_distance
+                        """
         warnings = """
                         Warning tools_warning
                         bad_orientation_points_in_some_layers
@@ -2893,6 +3589,7 @@ class laser_gcode(inkex.Effect):
         self.transform_matrix = {}
         self.transform_matrix_reverse = {}
         self.Zauto_scale = {}
+        self.transforms = {}
 
         def recursive_search(g, layer, selected=False):
             items = g.getchildren()
@@ -2982,44 +3679,22 @@ class laser_gcode(inkex.Effect):
 ################################################################################
     def laser(self) :
 
-        def get_boundaries(points):
-            minx,miny,maxx,maxy=None,None,None,None
-            out=[[],[],[],[]]
-            for p in points:
-                if minx==p[0]:
-                    out[0]+=[p]
-                if minx==None or p[0]<minx:
-                    minx=p[0]
-                    out[0]=[p]
-
-                if miny==p[1]:
-                    out[1]+=[p]
-                if miny==None or p[1]<miny:
-                    miny=p[1]
-                    out[1]=[p]
-
-                if maxx==p[0]:
-                    out[2]+=[p]
-                if maxx==None or p[0]>maxx:
-                    maxx=p[0]
-                    out[2]=[p]
-
-                if maxy==p[1]:
-                    out[3]+=[p]
-                if maxy==None or p[1]>maxy:
-                    maxy=p[1]
-                    out[3]=[p]
-            return out
-
-
         def remove_duplicates(points):
-            i=0
+            # Points closer than tolerance are merged, the first one is
+            # kept. Grid cells are of tolerance size, so only neighbour
+            # cells need to be checked.
+            cells={}
             out=[]
             for p in points:
-                for j in range(i,len(points)):
-                    if p==points[j]: points[j]=[None,None]
-                if p!=[None,None]: out+=[p]
-            i+=1
+                cx,cy=int(math.floor(p[0]/dxfpoints_tolerance)),int(math.floor(p[1]/dxfpoints_tolerance))
+                duplicate=False
+                for x in (cx-1,cx,cx+1):
+                    for y in (cy-1,cy,cy+1):
+                        for q in cells.get((x,y),()):
+                            if (p[0]-q[0])**2+(p[1]-q[1])**2 <= dxfpoints_tolerance**2: duplicate=True
+                if not duplicate:
+                    cells.setdefault((cx,cy),[]).append(p)
+                    out+=[p]
             return(out)
 
 
@@ -3044,22 +3719,23 @@ class laser_gcode(inkex.Effect):
              [2,3], # ru
              [2,1], # rd
             ]
+            # Point at the boundary has the smallest key, so each way is
+            # a sort by the first boundary and then by the second one
+            keys=[lambda p: p[0], lambda p: p[1], lambda p: -p[0], lambda p: -p[1]]
 
             minimal_way=[]
             minimal_len=None
-            minimal_way_type=None
             for w in ways:
-                tpoints=points[:]
-                cw=[]
-                for j in range(0,len(points)):
-                    p=get_boundaries(get_boundaries(tpoints)[w[0]])[w[1]]
-                    tpoints.remove(p[0])
-                    cw+=p
+                cw=sorted(points, key=lambda p: (keys[w[0]](p), keys[w[1]](p)))
                 curlen = get_way_len(cw)
                 if minimal_len==None or curlen < minimal_len:
                     minimal_len=curlen
                     minimal_way=cw
-                    minimal_way_type=w
+
+            # Nearest neighbour way from origin
+            cw=[points[k] for k,r in csp_subpaths_order([[p,p] for p in points])]
+            if minimal_len==None or get_way_len(cw) < minimal_len:
+                minimal_way=cw
 
             return minimal_way
 
@@ -3070,11 +3746,12 @@ class laser_gcode(inkex.Effect):
             paths = self.selected_paths
 
         self.check_dir()
-        gcode = ""
+        gcode = []
 
         biarc_group = inkex.etree.SubElement( list(self.selected_paths.keys())[0] if len(list(self.selected_paths.keys()))>0 else self.layers[0], inkex.addNS('g','svg') )
         print_(("self.layers=",self.layers))
         print_(("paths=",paths))
+        layers = []
         for layer in self.layers :
             if layer in paths :
                 print_(("layer",layer))
@@ -3096,12 +3773,61 @@ class laser_gcode(inkex.Effect):
                     else:
                         p += csp
                 dxfpoints=sort_dxfpoints(dxfpoints)
-                curve = self.parse_curve(p, layer)
-                self.draw_curve(curve, layer, biarc_group)
-                gcode += self.generate_gcode(curve, layer, 0)
+                layers.append([layer, self.transform_csp(p, layer) if len(p)>0 else []])
+
+        # Layers are ordered first, then runs of about equal count of
+        # segments are converted to Gcode. Runs do not cross layers.
+        # Starting workers takes about 0.01 s with fork and 0.3 s with spawn
+        # (Windows, macOS), serial export takes about 0.15 ms per segment,
+        # so with spawn workers pay off from 3000-4500 segments.
+        segments = sum(len(subpath)-1 for layer, p in layers for subpath in p)
+        parallel = segments >= self.options.parallel_min_segments and self.parallel_jobs() > 1
+        ordered = self.parallel_map(parallel_layer_order, [p for layer, p in layers], parallel)
+        tasks, task_layers = [], []
+        size = max(1, segments // (self.parallel_jobs()*parallel_tasks_per_job)) if parallel else 1e100
+        for i, (p, distances) in enumerate(ordered) :
+            if distances != None :
+                self.error(_("Rapid distance: %.1f in document order, %.1f nearest neighbour, %.1f improved") % distances, "rapid_distance")
+            run, n = [], 0
+            for subpath in p :
+                run.append(subpath)
+                n += len(subpath)-1
+                if n >= size :
+                    tasks.append(run)
+                    task_layers.append(i)
+                    run, n = [], 0
+            if len(run)>0 :
+                tasks.append(run)
+                task_layers.append(i)
+        results = self.parallel_map(parallel_gcode, tasks, parallel)
+
+        for i, (layer, p) in enumerate(layers) :
+            curve, g = [], []
+            for k in range(len(tasks)) :
+                if task_layers[k] == i :
+                    curve += results[k][0]
+                    g.append(results[k][1])
+            print_("Curve: " + str(curve))
+            self.draw_curve(curve, layer, biarc_group)
+            gcode.append("".join(g))
 
         self.export_gcode(gcode)
 
+
+    def parallel_jobs(self) :
+        return self.options.jobs if self.options.jobs > 0 else multiprocessing.cpu_count()
+
+
+    def parallel_map(self, function, tasks, parallel=True) :
+        # Results of function for each task in order of tasks. Small jobs
+        # and single tasks are processed in this process, otherwise pool
+        # of at most one worker per task is used.
+        jobs = min(self.parallel_jobs(), len(tasks))
+        if not parallel or jobs < 2 :
+            return [function(task) for task in tasks]
+        with multiprocessing.Pool(jobs, parallel_init, (parallel_options(self.options), self.tools)) as pool :
+            return pool.map(function, tasks)
+
 ################################################################################
 ###
 ###        Orientation
@@ -3213,5 +3939,6 @@ class laser_gcode(inkex.Effect):
         self.get_info()
         self.laser()
 
-e = laser_gcode()
-e.affect()
+if __name__ == '__main__':
+    e = laser_gcode()
+    e.affect()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+Batched cubic Bezier kernels for laser.py
+
+Segments are numpy arrays of shape (n,4,2) - control points of n cubic
+segments. Parameters t are arrays of shape (n,) or (n,m), one row of
+parameters per segment. laser.py converts cubic super paths with
+csp_to_segments() for subpath bounds, containment, kerf flattening and
+its segment grid, and evaluates all segments at once.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+import numpy
+
+
+def csp_to_segments(csp) :
+    # Returns segments of csp and [i,j] index of each of them, where i is
+    # subpath and j is node at the end of the segment.
+    segments, index = [], []
+    for i, subpath in enumerate(csp) :
+        for j in range(1, len(subpath)) :
+            segments.append( [subpath[j-1][1], subpath[j-1][2], subpath[j][0], subpath[j][1]] )
+            index.append( [i, j] )
+    return numpy.array(segments, dtype=float).reshape(-1,4,2), index
+
+
+def bernstein(t) :
+    # Cubic Bernstein basis, shape of t + (4,)
+    t = numpy.asarray(t, dtype=float)[...,None]
+    s = 1-t
+    return numpy.concatenate((s*s*s, 3*t*s*s, 3*t*t*s, t*t*t), axis=-1)
+
+
+def parameterize(b) :
+    # Polynomial coefficients a*t^3 + b*t^2 + c*t + d of each segment,
+    # same as bezmisc.bezierparameterize. Returns (n,4,2) array [a,b,c,d].
+    p0, p1, p2, p3 = b[:,0], b[:,1], b[:,2], b[:,3]
+    c = 3*(p1-p0)
+    b_ = 3*(p2-p1) - c
+    a = p3 - p0 - c - b_
+    return numpy.stack((a, b_, c, p0), axis=1)
+
+
+def _rows(b, t) :
+    # Broadcasts t to rows of parameters, returns (t with shape (n,m), squeeze)
+    t = numpy.asarray(t, dtype=float)
+    if t.ndim == 0 : t = numpy.full((len(b),1), float(t))
+    elif t.ndim == 1 : t = t[:,None]
+    else : return t, False
+    return t, True
+
+
+def at(b, t) :
+    # Points at t, shape (n,2) for t of shape (n,), (n,m,2) for (n,m)
+    t, squeeze = _rows(b, t)
+    q, t = parameterize(b)[:,:,None], t[...,None]
+    p = ((q[:,0]*t + q[:,1])*t + q[:,2])*t + q[:,3]
+    return p[:,0] if squeeze else p
+
+
+def bounds(b) :
+    # Exact bounds of each segment. Returns (minimum, maximum, t of
+    # minimum, t of maximum), each of shape (n,2) for x and y.
+    q = parameterize(b)
+    # Roots of the derivative 3a t^2 + 2b t + c for x and y
+    A, B, C = 3*q[:,0], 2*q[:,1], q[:,2]
+    with numpy.errstate(divide='ignore', invalid='ignore') :
+        disc = numpy.sqrt(B*B - 4*A*C)
+        quadratic = abs(A) > 1e-12
+        r1 = numpy.where(quadratic, (-B+disc)/(2*A), numpy.where(B!=0, -C/B, numpy.nan))
+        r2 = numpy.where(quadratic, (-B-disc)/(2*A), numpy.nan)
+    t = numpy.stack((numpy.zeros_like(r1), numpy.ones_like(r1), r1, r2), axis=-1)
+    t = numpy.where((t>=0) & (t<=1), t, 0.)
+    v = ((q[:,0,:,None]*t + q[:,1,:,None])*t + q[:,2,:,None])*t + q[:,3,:,None]
+    i_min, i_max = v.argmin(-1)[...,None], v.argmax(-1)[...,None]
+    take = lambda a, i : numpy.take_along_axis(a, i, -1)[...,0]
+    return take(v, i_min), take(v, i_max), take(t, i_min), take(t, i_max)
+
+
+def control_bounds(b) :
+    # Bounds of control polygons, rows [minx, miny, maxx, maxy]
+    return numpy.concatenate((b.min(1), b.max(1)), axis=1)
+
+
+def flatness_steps(b, tolerance) :
+    # Number of equal parameter steps keeping each segment flattened
+    # within tolerance. Control points distance from the chord bounds
+    # the deviation and drops by n^2 when the segment is split to n parts.
+    chord = b[:,3]-b[:,0]
+    l = numpy.hypot(chord[:,0], chord[:,1])
+    rel = b[:,1:3]-b[:,None,0]
+    cross = abs(chord[:,None,0]*rel[...,1] - chord[:,None,1]*rel[...,0]).max(1)
+    m = numpy.where(l > 1e-12, cross/numpy.where(l > 1e-12, l, 1), numpy.hypot(rel[...,0], rel[...,1]).max(1))
+    return numpy.maximum(1, numpy.ceil(numpy.sqrt(.75*m/tolerance))).astype(int)
+
+
+def flatten(b, tolerance) :
+    # Polyline through segments within tolerance, end of the last segment
+    # is not included (closed polylines repeat the first point there).
+    n = flatness_steps(b, tolerance)
+    k = numpy.repeat(numpy.arange(len(b)), n)
+    t = (numpy.arange(n.sum()) - numpy.repeat(numpy.cumsum(n)-n, n))/numpy.repeat(n, n).astype(float)
+    return numpy.einsum('nk,nkc->nc', bernstein(t), b[k])
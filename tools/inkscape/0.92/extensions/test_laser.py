@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+Regression cases of laser.py kerf compensation. laser.py needs inkex of
+Inkscape 0.92, run with its share/extensions directory on PYTHONPATH:
+
+    PYTHONPATH=/usr/share/inkscape/extensions python -m unittest test_laser
+"""
+import math
+import unittest
+
+try :
+    import laser
+except ImportError :
+    laser = None
+
+
+def rectangle(x1, y1, x2, y2) :
+    return polygon([(x1,y1), (x2,y1), (x2,y2), (x1,y2)])
+
+
+def polygon(points) :
+    return [[[x,y], [x,y], [x,y]] for x, y in points + points[:1]]
+
+
+def area(subpath) :
+    p = [sp[1] for sp in subpath]
+    return sum(p[i][0]*p[i+1][1] - p[i+1][0]*p[i][1] for i in range(len(p)-1))/2
+
+
+@unittest.skipIf(laser == None, "inkex of Inkscape 0.92 is not available")
+class Kerf_offset(unittest.TestCase) :
+    def offset(self, csp, r) :
+        return sorted(laser.csp_kerf_offset(csp, r), key=area, reverse=True)
+
+
+    def test_hole(self) :
+        result = self.offset([rectangle(0,0,10,10), rectangle(3,3,7,7)], .1)
+        self.assertEqual(len(result), 2)
+        self.assertAlmostEqual(area(result[0]), 100 + 4*10*.1 + math.pi*.01, delta=.01)
+        self.assertAlmostEqual(area(result[1]), -3.8**2, delta=.01)
+
+
+    def test_near_touching_parts_merge(self) :
+        result = self.offset([rectangle(0,0,10,10), rectangle(10.05,0,20.05,10)], .1)
+        self.assertEqual(len(result), 1)
+        xs, ys = [sp[1][0] for sp in result[0]], [sp[1][1] for sp in result[0]]
+        self.assertAlmostEqual(min(xs), -.1, delta=.001)
+        self.assertAlmostEqual(max(xs), 20.15, delta=.001)
+        self.assertGreater(area(result[0]), 20.05*10.2)
+
+
+    def test_narrow_slot_closes(self) :
+        for width, r in ((.05, .1), (.1, .2)) :
+            slot = polygon([(0,0), (10,0), (10,5-width/2), (2,5-width/2), (2,5+width/2), (10,5+width/2), (10,10), (0,10)])
+            result = self.offset([slot], r)
+            self.assertEqual(len(result), 1)
+            self.assertAlmostEqual(area(result[0]), 100 + 4*10*r + math.pi*r*r, delta=.01)
+
+
+    def test_wide_slot_stays(self) :
+        slot = polygon([(0,0), (10,0), (10,4), (2,4), (2,6), (10,6), (10,10), (0,10)])
+        result = self.offset([slot], .1)
+        self.assertEqual(len(result), 1)
+        self.assertLess(area(result[0]), 100)
+
+
+    def test_overlapping_parts_merge(self) :
+        # Union has 6 convex and 2 reflex corners
+        r = .1
+        result = self.offset([rectangle(0,0,10,10), rectangle(5,5,15,15)], r)
+        self.assertEqual(len(result), 1)
+        self.assertAlmostEqual(area(result[0]), 175 + 60*r + 1.5*math.pi*r*r - 2*r*r, delta=.01)
+
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+'''
+Created on Oct 18, 2026
+
+Vectorizes whole directory of bitmaps (or list of bitmaps in manifest
+file, one per line) with the same parameters. Files are converted by
+a pool of worker processes started once for the whole batch, each
+output is simulated by simulator.py and the summary of conversion time,
+count of lines and estimated job time is written next to the outputs.
+'''
+from simulator import Simulate, duration
+from vectorizer import Cache, GCode, Vectorize, parse_offsets
+import csv
+import multiprocessing
+import os
+import time
+
+
+EXTENSIONS = ('.bmp', '.gif', '.jpeg', '.jpg', '.pbm', '.pgm', '.png', '.ppm', '.tif', '.tiff')
+
+
+def inputs(source):
+    # Bitmaps in directory or listed in manifest, manifest paths are
+    # relative to manifest
+    if os.path.isdir(source):
+        return sorted(os.path.join(source, name) for name in os.listdir(source) if name.lower().endswith(EXTENSIONS))
+    
+    with open(source) as f:
+        lines = [line.strip() for line in f]
+    
+    return [os.path.join(os.path.dirname(source), line) for line in lines if line and not line.startswith('#')]
+
+
+def convert(task):
+    # Runs in worker process, returns one row of summary. Failure of one
+    # file is reported in its row instead of stopping the whole batch.
+    input, output, png, params = task
+    start = time.perf_counter()
+    
+    try:
+        return _convert(input, output, png, params, start) + ('',)
+    except Exception as e:
+        print('\tFailed {}: {}'.format(input, e))
+        return input, None, time.perf_counter() - start, 0, 0, '{}: {}'.format(type(e).__name__, e)
+
+
+def _convert(input, output, png, params, start):
+    cache      = Cache(params['cache'], params['limit']) if params['cache'] else None
+    vectorized = Vectorize(input, (params['width'], params['height']), params['dot'], params['bits'], params['bw'],
+                           png, params['trim'], params['dither'], params['tiled'], cache)
+    
+    gcode = GCode(output, vectorized, params['speed'], params['count'], params['min'], params['max'],
+'''; Parameters:
+;    batch.input  = {}
+;    batch.output = {}
+;    batch.width  = {}
+;    batch.height = {}
+;    batch.dot    = {}
+;    batch.speed  = {}
+;    batch.count  = {}
+;    batch.min    = {}
+;    batch.max    = {}
+;    batch.bits   = {}
+;    batch.bw     = {}
+'''.format(input, output, params['width'], params['height'], params['dot'], params['speed'], params['count'],
+           params['min'], params['max'], params['bits'], params['bw']),
+                  1, params['accel'], parse_offsets(params['offset']), params['compact'])
+    gcode.tune(params['rate'], params['baud'])
+    gcode.save()
+    
+    elapsed = time.perf_counter() - start
+    sim     = Simulate(output)
+    return input, output, elapsed, sim.lines, sim.time
+
+
+def batch(files, output, png, params, jobs = 1, summary = None):
+    # Outputs are named by inputs, summary rows keep order of inputs.
+    # Inputs of the same name (from other directories or with other
+    # extension) get numeric suffix, so no output is written twice.
+    os.makedirs(output, exist_ok = True)
+    tasks = []
+    names = set()
+    
+    for input in files:
+        stem = name = os.path.splitext(os.path.basename(input))[0]
+        i    = 1
+        
+        while name.lower() in names:
+            i   += 1
+            name = '{}-{}'.format(stem, i)
+        
+        names.add(name.lower())
+        tasks.append((input,
+                      os.path.join(output, name + '.gcode'),
+                      os.path.join(output, name + '.png') if png else None,
+                      params))
+    
+    summary = summary or os.path.join(output, 'summary.csv')
+    rows    = []
+    
+    with multiprocessing.Pool(jobs) as pool, open(summary, 'w', newline = '') as f:
+        writer = csv.writer(f)
+        writer.writerow(('input', 'output', 'seconds', 'lines', 'job seconds', 'job time', 'error'))
+        
+        for input, gcode, elapsed, lines, job, error in pool.imap(convert, tasks):
+            if error:
+                writer.writerow((input, '', '{:.2f}'.format(elapsed), '', '', '', error))
+            else:
+                writer.writerow((input, gcode, '{:.2f}'.format(elapsed), lines, '{:.1f}'.format(job), duration(job), ''))
+            
+            f.flush()
+            rows.append((input, elapsed, lines, job, error))
+    
+    return rows
+
+
+
+if __name__ == '__main__':
+    import click
+    
+    @click.command()
+    @click.argument('source', type = click.Path(exists = True))
+    @click.option('--output', '-o', type    = click.Path(), required = True, help = 'Output directory of G-CODE images')
+    @click.option('--summary','-y', type    = click.Path(), default  = None, help = 'Output summary CSV (default summary.csv in output directory)')
+    @click.option('--png',    '-p', is_flag = True,                          help = 'Write final PNG image of each file too')
+    @click.option('--width',  '-w',                         default  = 100,  help = 'Final image width in mm')
+    @click.option('--height', '-h',                         default  = 100,  help = 'Final image height in mm')
+    @click.option('--dot',    '-d', type    = float,        default  = 0.1,  help = 'Laser path width')
+    @click.option('--speed',  '-s', type    = int,          default  = 1000, help = 'Laser burn speed')
+    @click.option('--count',  '-c', type    = int,          default  = 16,   help = 'Count of low power marker cycles')
+    @click.option('--min',    '-m', type    = int,          default  = 80,   help = 'Minimal non-zero intensity')
+    @click.option('--max',    '-x', type    = int,          default  = 255,  help = 'Maximal intensity')
+    @click.option('--bits',   '-t',                         default  = 8,    help = 'Bit resolution of image')
+    @click.option('--bw',     '-l', is_flag = True,                          help = 'Rather use BW instead of grayscale')
+    @click.option('--dither', '-e', type    = int,          default  = 0,    help = 'Rather use error diffused BW with runs of at least given count of pixels')
+    @click.option('--tiled',  '-g', is_flag = True,                          help = 'Resample huge input images in strips of rows')
+    @click.option('--cache',  '-k', type    = click.Path(), default  = None, help = 'Directory caching quantized rasters between runs')
+    @click.option('--limit',  '-q', type    = int,          default  = 256,  help = 'Size limit of raster cache in MB')
+    @click.option('--trim',   '-r', is_flag = True,                          help = 'Skip white rows and white row margins')
+    @click.option('--accel',  '-a', type    = float,        default  = 0,    help = 'Head acceleration in mm/s^2 for sweep overscan (0 disables overscan)')
+    @click.option('--offset', '-f', type    = str,          default  = None, help = 'Reverse rows shift table "speed:mm,speed:mm,..." (see calibrate.py)')
+    @click.option('--compact','-z', is_flag = True,                          help = 'Write shortest G-CODE (no spaces, trailing zeros and repeated power)')
+    @click.option('--rate',   '-b', type    = int,          default  = 0,    help = 'Peak commands per second firmware handles (0 - no limit)')
+    @click.option('--baud',   '-u', type    = int,          default  = 0,    help = 'Baud rate of serial line feeding G-CODE (0 - SD card)')
+    @click.option('--jobs',   '-j', type    = int,          default  = multiprocessing.cpu_count(), help = 'Count of worker processes')
+    def run(source, output, summary, png, jobs, **params):
+        files = inputs(source)
+        print('Vectorizing {} files in {} processes'.format(len(files), jobs))
+        start = time.perf_counter()
+        rows  = batch(files, output, png, params, jobs, summary)
+        
+        print('{:<40} {:>10} {:>10} {:>10}'.format('Input', 'Seconds', 'Lines', 'Job time'))
+        
+        for input, elapsed, lines, job, error in rows:
+            if error:
+                print('{:<40} {:>10.2f} {:>10} {:>10}'.format(os.path.basename(input)[:40], elapsed, 'failed', '-'))
+            else:
+                print('{:<40} {:>10.2f} {:>10} {:>10}'.format(os.path.basename(input)[:40], elapsed, lines, duration(job)))
+        
+        print('{:<40} {:>10.2f} {:>10} {:>10}'.format('Total',
+                                                      time.perf_counter() - start,
+                                                      sum(row[2] for row in rows),
+                                                      duration(sum(row[3] for row in rows))))
+        
+        failed = [row[0] for row in rows if row[4]]
+        
+        if failed:
+            print('Failed {} of {} files, see summary for errors'.format(len(failed), len(rows)))
+        
+        print('Done ...')
+    
+    
+    run()
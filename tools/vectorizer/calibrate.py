@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+'''
+Created on Oct 18, 2026
+
+Generates pattern for calibration of reverse rows shift used by
+vectorizer.py --offset. Pattern contains block of vertical bars for
+each tested shift. Pick the block with the straightest bar edges and
+use its shift for the burn speed.
+'''
+from PIL import Image, ImageDraw
+from vectorizer import GCode, rasterize_band
+import numpy
+
+
+class Pattern:
+    def __init__(self, shifts, width = 0.1, bar = 1.0, length = 20.0, height = 4.0, gap = 2.0):
+        print('\tCreating calibration pattern ...')
+        
+        # Block of bars for each shift with label on the left side
+        label  = int(height * 3 / width)
+        bar    = max(1, int(bar    / width))
+        length = max(1, int(length / width))
+        height = max(1, int(height / width))
+        gap    = max(1, int(gap    / width))
+        size   = (label + length, len(shifts) * (height + gap) - gap)
+        bitmap = Image.new('L', size, 255)
+        draw   = ImageDraw.Draw(bitmap)
+        
+        self.blocks = []
+        self.shifts = shifts
+        
+        for i, shift in enumerate(shifts):
+            y0 = i * (height + gap)
+            
+            for x in range(label, label + length, 2 * bar):
+                draw.rectangle((x, y0, x + bar - 1, y0 + height - 1), fill = 0)
+            
+            text = Image.new('L', draw.textbbox((0, 0), '{:+.3f}'.format(shift))[2:], 255)
+            ImageDraw.Draw(text).text((0, 0), '{:+.3f}'.format(shift), fill = 0)
+            text = text.resize((min(label - bar, text.size[0] * height // text.size[1]), height), Image.NEAREST)
+            bitmap.paste(text, (0, y0))
+            
+            self.blocks.append((y0, y0 + height))
+        
+        self.size   = ((size[0] * width, size[1] * width), size)
+        self.width  = width
+        self.trim   = True
+        self.raster = numpy.asarray(bitmap, dtype = numpy.uint8).copy()
+    
+    
+    def bands(self, height):
+        for y in range(0, self.raster.shape[0], height):
+            yield self.raster[y:y + height], y
+
+
+
+class CalibrationGCode(GCode):
+    def _shifts(self):
+        return self.vectorized.shifts
+    
+    
+    def _bands(self):
+        # Each block is rasterized with its own shift
+        job = self._job()
+        
+        for (y0, y1), shift in zip(self.vectorized.blocks, self.vectorized.shifts):
+            yield rasterize_band((self.vectorized.raster[y0:y1], y0, dict(job, shift = shift)))
+
+
+
+if __name__ == '__main__':
+    import click
+    
+    @click.command()
+    @click.option('--output', '-o', type    = click.Path(), required = True, help = 'Output G-CODE pattern')
+    @click.option('--png',    '-p', type    = click.Path(), default  = None, help = 'Output PNG of pattern')
+    @click.option('--dot',    '-d', type    = float,        default  = 0.1,  help = 'Laser path width')
+    @click.option('--speed',  '-s', type    = int,          default  = 1000, help = 'Laser burn speed')
+    @click.option('--min',    '-m', type    = int,          default  = 80,   help = 'Minimal non-zero intensity')
+    @click.option('--max',    '-x', type    = int,          default  = 255,  help = 'Maximal intensity')
+    @click.option('--accel',  '-a', type    = float,        default  = 0,    help = 'Head acceleration in mm/s^2 for sweep overscan (0 disables overscan)')
+    @click.option('--first',  '-f', type    = float,        default  = -0.2, help = 'First tested shift in mm')
+    @click.option('--last',   '-l', type    = float,        default  = 0.2,  help = 'Last tested shift in mm')
+    @click.option('--step',   '-t', type    = float,        default  = 0.05, help = 'Step of tested shifts in mm')
+    def run(output, png, dot, speed, min, max, accel, first, last, step):
+        print('Calibrating reverse rows shift at speed ', speed)
+        shifts  = [s + 0.0 for s in numpy.arange(first, last + step / 2, step).round(3).tolist()]
+        pattern = Pattern(shifts, dot)
+        
+        if png:
+            print('Writing PNG bitmap to ', png)
+            Image.fromarray(pattern.raster, 'L').save(png)
+        
+        print('Writing G-CODE to ', output)
+        gcode = CalibrationGCode(output, pattern, speed, 0, min, max,
+'''; Parameters:
+;    calibrate.output = {}
+;    calibrate.dot    = {}
+;    calibrate.speed  = {}
+;    calibrate.min    = {}
+;    calibrate.max    = {}
+;    calibrate.accel  = {}
+;    calibrate.shifts = {}
+'''.format(output, dot, speed, min, max, accel, shifts), accel = accel)
+        gcode.save()
+        print('Done ...')
+    
+    
+    run()
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+'''
+Created on Oct 18, 2026
+
+Estimates run time of laser G-CODE (vectorizer.py, prusa2laser.py and
+Inkscape laser.py output). Moves are planned like Marlin planner does
+it - trapezoidal speed profiles, junction deviation and limited look
+ahead - as whole-array operations, so even raster jobs with millions
+of lines are simulated in seconds.
+
+Sections of the report start with a full line comment following an
+empty line, e.g. "; Engraving code".
+'''
+import math
+import re
+import numpy
+
+
+# Defaults taken from Marlin/Configuration.h and Configuration_adv.h
+ACCELERATION     = 500          # DEFAULT_ACCELERATION (mm/s^2)
+JUNCTION         = 0.013        # JUNCTION_DEVIATION_MM (mm)
+MAX_FEEDRATE     = 300          # DEFAULT_MAX_FEEDRATE X, Y (mm/s)
+BLOCK_BUFFER     = 16           # BLOCK_BUFFER_SIZE
+DEFAULT_FEEDRATE = 1500 / 60    # Marlin feedrate_mm_s at start (mm/s)
+DEFAULT_TONE     = 1000         # M300 default duration (ms)
+
+WORD             = re.compile(r'([A-Z])\s*([-+]?[0-9]*\.?[0-9]+)')
+COMMENT          = re.compile(r'[;#(]')
+
+# Kinds of moves which are not arcs
+MOVE             = -1
+JUMP             = -2
+
+
+class Simulate:
+    def __init__(self, file, accel = ACCELERATION, junction = JUNCTION, feedrate = MAX_FEEDRATE, buffer = BLOCK_BUFFER):
+        print('\tSimulating file ', file)
+        self.file     = file
+        self.accel    = accel
+        self.junction = junction
+        self.feedrate = feedrate
+        self.buffer   = buffer
+        
+        # Target of each move, sections of program and arcs (length
+        # and direction at start and end)
+        self.sections = [['', 0.0]]
+        self.lines    = 0
+        self._moves   = []
+        self._arcs    = []
+        
+        with open(file) as f:
+            self._parse(f)
+        
+        self._plan()
+    
+    
+    def report(self):
+        print('\t\t{:<32} {:>10} {:>12} {:>12}'.format('Section', 'Time', 'Burn (mm)', 'Travel (mm)'))
+        
+        for name, time, burn, travel in self.breakdown:
+            print('\t\t{:<32} {:>10} {:>12.1f} {:>12.1f}'.format(name[:32], duration(time), burn, travel))
+        
+        print('\t\t{:<32} {:>10} {:>12.1f} {:>12.1f}'.format('Total', duration(self.time), self.burn, self.travel))
+    
+    
+    def _parse(self, f):
+        pos      = [0.0, 0.0, 0.0]
+        absolute = True
+        scale    = 1.0
+        feed     = DEFAULT_FEEDRATE
+        power    = 0.0
+        stops    = 0
+        blank    = True
+        codes    = {}
+        moves    = self._moves
+        
+        for line in f:
+            self.lines += 1
+            raw         = line.strip()
+            
+            if not raw:
+                blank = True
+                continue
+            
+            # New section starts with comment after empty line
+            if ';' == raw[0]:
+                if blank and raw.strip('; '):
+                    self.sections.append([raw.strip('; '), 0.0])
+                
+                blank = False
+                continue
+            
+            blank = False
+            
+            if ';' in raw or '(' in raw or '#' in raw:
+                raw = COMMENT.split(raw, maxsplit = 1)[0]
+            
+            words = WORD.findall(raw.upper())
+            
+            if not words:
+                continue
+            
+            try:
+                cmd = codes[words[0]]
+            except KeyError:
+                cmd = codes[words[0]] = words[0][0] + str(int(float(words[0][1])))
+            
+            params = dict(words[1:])
+            
+            if 'F' in params:
+                feed = float(params['F']) * scale / 60
+            
+            if cmd in ('G0', 'G1', 'G2', 'G3'):
+                if 'S' in params:
+                    power = float(params['S'])
+                
+                target = list(pos)
+                
+                for i, axis in enumerate('XYZ'):
+                    if axis in params:
+                        target[i] = float(params[axis]) * scale + (0 if absolute else pos[i])
+                
+                arc = MOVE
+                
+                if not cmd in ('G0', 'G1'):
+                    arc = self._arc(pos, target, params, scale, 'G2' == cmd)
+                
+                pos = target
+                moves.append((*pos, feed, power, len(self.sections) - 1, stops, arc))
+            
+            elif 'G4' == cmd:
+                self._dwell(float(params.get('P', 0)) / 1000 + float(params.get('S', 0)))
+                stops += 1
+            
+            elif 'G20' == cmd:
+                scale = 25.4
+            
+            elif 'G21' == cmd:
+                scale = 1.0
+            
+            elif 'G28' == cmd:
+                # Homing time depends on machine, head ends in origin
+                pos    = [0.0, 0.0, 0.0]
+                stops += 1
+                moves.append((*pos, feed, 0, len(self.sections) - 1, stops, JUMP))
+            
+            elif 'G90' == cmd:
+                absolute = True
+            
+            elif 'G91' == cmd:
+                absolute = False
+            
+            elif 'G92' == cmd:
+                for i, axis in enumerate('XYZ'):
+                    if axis in params:
+                        pos[i] = float(params[axis]) * scale
+                
+                stops += 1
+                moves.append((*pos, feed, 0, len(self.sections) - 1, stops, JUMP))
+            
+            elif 'G93' == cmd:
+                # Locate area runs till user stops it, count one lap of frame
+                x, y   = float(params.get('X', 0)) * scale, float(params.get('Y', 0)) * scale
+                w, h   = float(params.get('I', 0)) * scale, float(params.get('J', 0)) * scale
+                stops += 1
+                
+                for x, y in ((x, y), (x + w, y), (x + w, y + h), (x, y + h), (x, y)):
+                    pos    = [x, y, pos[2]]
+                    stops += 1
+                    moves.append((*pos, feed, 0, len(self.sections) - 1, stops, MOVE))
+            
+            elif cmd in ('M3', 'M4'):
+                power = float(params.get('S', 255))
+            
+            elif 'M5' == cmd:
+                power = 0.0
+            
+            elif 'M300' == cmd:
+                self._dwell(float(params.get('P', DEFAULT_TONE)) / 1000)
+                stops += 1
+            
+            elif 'M400' == cmd:
+                stops += 1
+    
+    
+    def _arc(self, start, end, params, scale, cw):
+        dx, dy = end[0] - start[0], end[1] - start[1]
+        
+        if 'R' in params:
+            # Center is on the right side of chord for clockwise arcs
+            r     = float(params['R']) * scale
+            chord = math.hypot(dx, dy)
+            
+            if 0 == chord:
+                return MOVE
+            
+            h      = math.sqrt(max(0, r**2 - (chord / 2)**2)) * (1 if cw == (r > 0) else -1)
+            center = (start[0] + dx / 2 + h * dy / chord, start[1] + dy / 2 - h * dx / chord)
+            r      = abs(r)
+        else:
+            center = (start[0] + float(params.get('I', 0)) * scale, start[1] + float(params.get('J', 0)) * scale)
+            r      = math.hypot(start[0] - center[0], start[1] - center[1])
+        
+        a0    = math.atan2(start[1] - center[1], start[0] - center[0])
+        a1    = math.atan2(end[1]   - center[1], end[0]   - center[0])
+        sweep = (a0 - a1 if cw else a1 - a0) % (2 * math.pi)
+        sign  = -1 if cw else 1
+        
+        if 0 == sweep:
+            sweep = 2 * math.pi
+        
+        self._arcs.append((math.hypot(r * sweep, end[2] - start[2]),
+                           -sign * math.sin(a0), sign * math.cos(a0), 0,
+                           -sign * math.sin(a1), sign * math.cos(a1), 0))
+        return len(self._arcs) - 1
+    
+    
+    def _dwell(self, time):
+        self.sections[-1][1] += time
+    
+    
+    def _plan(self):
+        moves = numpy.array(self._moves, dtype = numpy.float64).reshape(-1, 8)
+        kind  = moves[:, 7].astype(numpy.int64)
+        end   = moves[:, 0:3]
+        start = numpy.concatenate((numpy.zeros((1, 3)), end[:-1]))
+        
+        # Lines go straight, arcs have their own length and directions
+        d      = end - start
+        length = numpy.sqrt((d**2).sum(axis = 1))
+        u0     = d / numpy.maximum(length, 1e-12)[:, None]
+        u1     = u0.copy()
+        
+        if self._arcs:
+            arcs         = numpy.array(self._arcs)
+            arc          = kind >= 0
+            length[arc]  = arcs[kind[arc], 0]
+            u0[arc]      = arcs[kind[arc], 1:4]
+            u1[arc]      = arcs[kind[arc], 4:7]
+        
+        # Keep real moves only, stop between moves is kept when any
+        # synchronizing command was seen since previous move
+        real    = (kind != JUMP) & (length > 0)
+        stops   = moves[real, 6]
+        stop    = numpy.concatenate(([True], stops[1:] > stops[:-1]))
+        length  = length[real]
+        u0      = u0[real]
+        u1      = u1[real]
+        feed    = numpy.minimum(moves[real, 3], self.feedrate)
+        burn    = moves[real, 4] > 0
+        section = moves[real, 5].astype(numpy.int64)
+        n       = length.size
+        a2      = 2 * self.accel
+        
+        # Junction speed limit (squared) at start of each segment
+        limit = numpy.zeros(n + 1)
+        
+        if n > 1:
+            cos        = numpy.clip(-(u0[1:] * u1[:-1]).sum(axis = 1), -1, 1)
+            sin        = numpy.sqrt(0.5 * (1 - cos))
+            vj         = self.accel * self.junction * sin / numpy.maximum(1 - sin, 1e-9)
+            vj         = numpy.where(cos > 0.999999, 0, vj)
+            vj         = numpy.where(cos < -0.999999, numpy.inf, vj)
+            vj         = numpy.minimum(vj, numpy.minimum(feed[1:], feed[:-1])**2)
+            limit[1:n] = numpy.where(stop[1:], 0, vj)
+        
+        # Planner has to be able to stop within look ahead buffer
+        s     = numpy.concatenate(([0], numpy.cumsum(length)))
+        ahead = s[numpy.minimum(numpy.arange(n + 1) + self.buffer, n)] - s
+        limit = numpy.minimum(limit, a2 * ahead)
+        
+        # Entry speeds reachable by accelerating from previous limits and
+        # by decelerating to following ones (min-plus prefix scans)
+        fwd   = numpy.minimum.accumulate(limit - a2 * s) + a2 * s
+        bwd   = numpy.minimum.accumulate((limit + a2 * s)[::-1])[::-1] - a2 * s
+        entry = numpy.maximum(numpy.minimum(fwd, bwd), 0)
+        
+        # Trapezoid (or triangle) time of each segment
+        vi    = numpy.sqrt(entry[:-1])
+        vo    = numpy.sqrt(entry[1:])
+        vn    = feed
+        da    = (vn**2 - vi**2) / a2
+        dd    = (vn**2 - vo**2) / a2
+        trap  = da + dd <= length
+        vp    = numpy.where(trap, vn, numpy.sqrt(numpy.maximum((a2 * length + vi**2 + vo**2) / 2, 0)))
+        time  = (vp - vi) / self.accel + (vp - vo) / self.accel
+        time += numpy.where(trap, (length - da - dd) / vn, 0)
+        
+        # Per section breakdown
+        count          = len(self.sections)
+        times          = numpy.bincount(section, time, count) + [i[1] for i in self.sections]
+        burns          = numpy.bincount(section, numpy.where(burn, length, 0), count)
+        travels        = numpy.bincount(section, numpy.where(burn, 0, length), count)
+        self.breakdown = [(name, float(t), float(b), float(v)) for (name, dwell), t, b, v in zip(self.sections, times, burns, travels)
+                                                                if t or b or v]
+        self.time      = float(times.sum())
+        self.burn      = float(burns.sum())
+        self.travel    = float(travels.sum())
+
+
+
+def duration(seconds):
+    seconds = int(round(seconds))
+    return '{}:{:02d}:{:02d}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+
+if __name__ == '__main__':
+    import click
+    
+    @click.command()
+    @click.argument('files', nargs = -1, type = click.Path(exists = True), required = True)
+    @click.option('--accel',    '-a', type = float, default = ACCELERATION, help = 'Acceleration in mm/s^2')
+    @click.option('--junction', '-j', type = float, default = JUNCTION,     help = 'Junction deviation in mm')
+    @click.option('--feedrate', '-f', type = float, default = MAX_FEEDRATE, help = 'Maximal feedrate in mm/s')
+    @click.option('--buffer',   '-b', type = int,   default = BLOCK_BUFFER, help = 'Count of blocks in planner buffer')
+    def run(files, accel, junction, feedrate, buffer):
+        for file in files:
+            sim = Simulate(file, accel, junction, feedrate, buffer)
+            sim.report()
+    
+    
+    run()
@@ -6,13 +6,59 @@ Created on Nov 29, 2020
 '''
 #from svgwrite import Drawing, rgb
 from PIL import Image
+import hashlib
+import math
+import multiprocessing
+import numpy
+import os
+import zipfile
+
+
+WRITE_BUFFER = 1 << 20
+BAND_HEIGHT  = 32
+TRAVEL_SPEED = 3000
+
+# Count of source image rows resampled at once in tiled mode
+TILE_ROWS    = 512
+LANCZOS_SIZE = 3
+
+# Default size limit of raster cache in MB
+CACHE_SIZE   = 256
+
+# Budget estimation - count of consecutive moves seen by planner,
+# count of bands formatted to measure line length and tuning steps
+PLANNER_MOVES = 16
+SAMPLE_BANDS  = 16
+TUNE_BITS     = 4
+TUNE_RUN      = 8
+
+# Contour mode - vertices of each closed path tried as its start and
+# tolerance growth steps while tuning
+CANDIDATES    = 16
+TUNE_STEPS    = 4
+
+# Marching squares segments between cell edge midpoints (dx, dy in
+# half pixels) for each case of corners tl * 8 + tr * 4 + br * 2 + bl.
+# Segments keep burned pixels on the left, diagonal pixels of saddles
+# stay apart.
+T, R, B, L    = (0, -1), (1, 0), (0, 1), (-1, 0)
+MARCHING      = [[], [(B, L)], [(R, B)], [(R, L)],
+                 [(T, R)], [(T, R), (B, L)], [(T, B)], [(T, L)],
+                 [(L, T)], [(B, T)], [(L, T), (R, B)], [(R, T)],
+                 [(L, R)], [(B, R)], [(L, B)], []]
+
+# Formatting tables for compact G-code - millimeter fractions without
+# trailing zeros and laser power words
+FRACTIONS    = [''] + ['.' + '{:03d}'.format(i).rstrip('0') for i in range(1, 1000)]
+POWERS       = ['S{}'.format(i) for i in range(256)]
 
 
 class Vectorize:
-    def __init__(self, bitmap, size, width = 0.1, bits = 4, bw = False, file = None):
+    def __init__(self, bitmap, size, width = 0.1, bits = 4, bw = False, file = None, trim = False, dither = 0, tiled = False, cache = None):
         # Read image
         print('\tVectorizing file ...')
         print('\t\tOpening file ', bitmap)
+        path   = bitmap
         bitmap = Image.open(bitmap)
         
         
@@ -24,12 +70,41 @@ class Vectorize:
                   (int(bitmap.size[0] * factor),
                    int(bitmap.size[1] * factor)))
         
+        self.size   = size
+        self.width  = width
+        self.trim   = trim
+        self.dither = dither
+        self.file   = file
+        self.source = None
+        
         print('\t\tResizing to: {} x {} : {} ({:.1f} x {:.1f} mm - F {})'.format(*size[1], width,
                                                                                   size[0][0],
                                                                                   size[0][1],
                                                                                   factor))
-        bitmap = bitmap.resize(size[1], Image.LANCZOS)
-        bitmap = bitmap.convert('L')
+        
+        # Skip resizing and quantization if the same raster was built
+        # before, only G-CODE parameters differ
+        key    = cache.key(path, size[1], width, bits, bw, dither, tiled) if cache else None
+        cached = cache.load(key) if cache else None
+        
+        if cached:
+            print('\t\tUsing cached raster ', key[:16])
+            self.raster, self.source = cached
+        else:
+            self._quantize(bitmap, bits, bw, tiled)
+            
+            if cache:
+                cache.store(key, self.raster, self.source)
+        
+        self._png()
+    
+    
+    def _quantize(self, bitmap, bits, bw, tiled):
+        if tiled:
+            bitmap = Image.fromarray(resample(bitmap, self.size[1]), 'L')
+        else:
+            bitmap = bitmap.resize(self.size[1], Image.LANCZOS)
+            bitmap = bitmap.convert('L')
         
         
         # Create BW variant if required
@@ -39,66 +114,675 @@ class Vectorize:
         
         
         
-        # Draw lines
-        self.size = size
-        reducto   = 2**(8 - bits)
-        moves     = []
+        # Quantize whole image at once
+        reducto     = 2**(8 - bits)
+        self.raster = numpy.asarray(bitmap, dtype = numpy.uint8).copy()
+        
+        if self.dither:
+            print('\t\tDithering to BW - runs of {} pixels at least'.format(self.dither))
+            self.source = self.raster
+            self.raster = diffuse(self.source, self.dither)
+        else:
+            self.raster[:, 1:] //= reducto
+            self.raster[:, 1:] *=  reducto
+    
+    
+    def simplify(self, bits, run):
+        # Reduce count of intensity changes - less intensity levels
+        # (white stays white) and runs of given count of pixels at least
+        print('\t\tSimplifying to {} bits and runs of {} pixels'.format(bits, run))
         
-        print('\t\tVectorizing ...')
-        # Process row
-        for y in range(size[1][1]):
-            # Optimize for speed - use zig-zag lines
-            if 0 == y % 2:
-                env = range(1, size[1][0]),           (0, size[1][0])
-            else:
-                env = reversed(range(1, size[1][0])), (size[1][0], 0)
+        if self.dither:
+            self.raster = diffuse(self.source, max(run, self.dither))
+        else:
+            if self.source is None:
+                self.source = self.raster.copy()
             
-            # Process line
-            yy = y * width
-            c  = 255
+            reducto     = 2**(8 - bits)
+            self.raster = self.source.copy()
             
-            moves.append(((env[1][0], y), (env[1][0] * width, yy), c))
+            self.raster[:, 1:] = 255 - (255 - self.raster[:, 1:]) // reducto * reducto
+            self.raster        = hold(self.raster, run)
+        
+        self._png()
+    
+    
+    def bands(self, height):
+        # Split image to horizontal bands of rows, each band is
+        # rasterized independently, so band can run in other process
+        for y in range(0, self.raster.shape[0], height):
+            yield self.raster[y:y + height], y
+    
+    
+    def _png(self):
+        if self.file:
+            print('Writing PNG bitmap to ', self.file)
+            Image.fromarray(self.raster, 'L').save(self.file)
+
+
+
+class Cache:
+    def __init__(self, path, limit = CACHE_SIZE):
+        # Directory of quantized rasters named by hash of input file and
+        # parameters of quantization, least recently used rasters are
+        # removed when directory exceeds limit in MB
+        self.path  = path
+        self.limit = limit * 2**20
+        
+        os.makedirs(path, exist_ok = True)
+    
+    
+    def key(self, file, *params):
+        digest = hashlib.sha256()
+        
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(WRITE_BUFFER), b''):
+                digest.update(chunk)
+        
+        digest.update(repr(params).encode())
+        return digest.hexdigest()
+    
+    
+    def load(self, key):
+        name = os.path.join(self.path, key + '.npz')
+        
+        try:
+            with numpy.load(name) as data:
+                cached = data['raster'], data['source'] if 'source' in data else None
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            return None
+        
+        # Modification time is time of last use
+        os.utime(name)
+        return cached
+    
+    
+    def store(self, key, raster, source = None):
+        name   = os.path.join(self.path, key + '.npz')
+        temp   = '{}.{}.tmp'.format(name, os.getpid())
+        arrays = dict(raster = raster) if source is None else dict(raster = raster, source = source)
+        
+        with open(temp, 'wb') as f:
+            numpy.savez_compressed(f, **arrays)
+        
+        os.replace(temp, name)
+        self._evict()
+    
+    
+    def _evict(self):
+        files = []
+        
+        # Other processes may share the cache, so files can disappear
+        for entry in os.scandir(self.path):
+            try:
+                if entry.name.endswith('.npz'):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+            except FileNotFoundError:
+                pass
+        
+        total = sum(size for _, size, _ in files)
+        
+        for _, size, name in sorted(files):
+            if total <= self.limit:
+                break
             
-            for x in env[0]:
-                c  = (bitmap.getpixel((x, y)) // reducto) * reducto
-                bitmap.putpixel((x, y), c)
-                xx = x * width
-                moves.append(((x, y), (xx, yy), c))
+            print('\t\tRemoving cached raster ', os.path.basename(name)[:16])
+            total -= size
             
-            moves.append(((env[1][1], y), (env[1][1] * width, yy), c))
-        
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+
+
+
+def resample(bitmap, size):
+    # Resize image to size (and convert it to grayscale) in strips of
+    # rows. Only one strip of source image exists in memory at a time,
+    # strips overlap by filter support so results match whole image
+    # resize (up to rounding).
+    source = strips(bitmap, size)
+    w, h   = bitmap.size
+    scale  = h / size[1]
+    rows   = max(1, int(TILE_ROWS / scale))
+    margin = int(math.ceil(LANCZOS_SIZE * max(scale, 1))) + 2
+    out    = numpy.empty((size[1], size[0]), dtype = numpy.uint8)
+    
+    print('\t\tResampling in strips of {} rows'.format(rows))
+    
+    for y0 in range(0, size[1], rows):
+        y1    = min(y0 + rows, size[1])
+        sy0   = max(0, int(y0 * scale) - margin)
+        sy1   = min(h, int(math.ceil(y1 * scale)) + margin)
+        strip = source(sy0, sy1).resize((size[0], y1 - y0), Image.LANCZOS, box = (0, y0 * scale - sy0, w, y1 * scale - sy0))
         
-        # Optimize level 2 - merge vertical or horizontal moves
-        # with the same intensity
-        moves_opt = []
-        chunk     = []
+        out[y0:y1] = numpy.asarray(strip.convert('L'))
+    
+    return out
+
+
+def strips(bitmap, size):
+    # Returns function reading strip of source rows. Uncompressed
+    # images are memory mapped, JPEG is decoded in reduced scale when
+    # it is much bigger than needed and the rest is decoded whole.
+    modes = {'L'    : ('L',    1, [0]),
+             'RGB'  : ('RGB',  3, [0, 1, 2]),
+             'BGR'  : ('RGB',  3, [2, 1, 0]),
+             'RGBA' : ('RGBA', 4, [0, 1, 2, 3]),
+             'RGBX' : ('RGB',  4, [0, 1, 2])}
+    tiles = bitmap.tile
+    
+    if tiles and all('raw' == t[0] for t in tiles):
+        args    = tiles[0][3] if isinstance(tiles[0][3], tuple) else (tiles[0][3],)
+        rawmode = args[0]
         
-        for move in moves:
-            chunk.append(move)
+        if rawmode in modes and 1 == len(tiles):
+            mode, channels, order = modes[rawmode]
+            w, h                  = bitmap.size
+            stride                = args[1] if len(args) > 1 and args[1] else w * channels
+            pixels                = numpy.memmap(bitmap.filename, dtype = numpy.uint8, mode = 'r',
+                                                 offset = tiles[0][2], shape = (h, stride))
+            
+            if len(args) > 2 and args[2] < 0:
+                pixels = pixels[::-1]
+            
+            pixels = pixels[:, :w * channels].reshape(h, w, channels)
             
-            if len(chunk) < 2:
-                continue
+            print('\t\tMemory mapping source image')
+            return lambda y0, y1: Image.fromarray(pixels[y0:y1][:, :, order].squeeze(2) if 1 == channels else
+                                                  pixels[y0:y1][:, :, order], mode)
+    
+    if 'JPEG' == bitmap.format:
+        bitmap.draft(bitmap.mode, (2 * size[0], 2 * size[1]))
+    
+    bitmap.load()
+    return lambda y0, y1: bitmap.crop((0, y0, bitmap.size[0], y1))
+
+
+def diffuse(raster, run):
+    # Floyd-Steinberg error diffusion to BW, where laser keeps its state
+    # for given count of pixels at least. That limits count of power
+    # changes per second, while error diffusion keeps average intensity.
+    #
+    # Pixel (x, y) depends on pixels (x - 1, y) and (x - 1 .. x + 1, y - 1)
+    # only, so all pixels on line x + 2 * y = t are processed at once.
+    h, w  = raster.shape
+    error = raster.astype(numpy.float32)
+    out   = numpy.empty((h, w), dtype = numpy.uint8)
+    state = numpy.zeros(h, dtype = numpy.bool_)
+    count = numpy.zeros(h, dtype = numpy.int32)
+    
+    for t in range(w + 2 * h - 2):
+        ys = numpy.arange(max(0, (t - w + 2) // 2), min(h - 1, t // 2) + 1)
+        xs = t - 2 * ys
+        
+        # New run starts only when current one is long enough
+        burn = error[ys, xs] < 128
+        keep = (count[ys] < run) & (xs > 0)
+        burn = numpy.where(keep, state[ys], burn)
+        
+        count[ys] = numpy.where(burn == state[ys], count[ys] + 1, 1)
+        state[ys] = burn
+        v         = numpy.where(burn, 0, 255).astype(numpy.uint8)
+        out[ys, xs] = v
+        e           = error[ys, xs] - v
+        
+        m = xs < w - 1
+        error[ys[m], xs[m] + 1] += e[m] * (7 / 16)
+        
+        m = ys < h - 1
+        ys, xs, e = ys[m] + 1, xs[m], e[m]
+        error[ys, xs] += e * (5 / 16)
+        
+        m = xs > 0
+        error[ys[m], xs[m] - 1] += e[m] * (3 / 16)
+        
+        m = xs < w - 1
+        error[ys[m], xs[m] + 1] += e[m] * (1 / 16)
+    
+    return out
+
+
+def hold(raster, run):
+    # Keep intensity for given count of pixels at least, so shorter
+    # runs are merged into previous ones
+    h, w  = raster.shape
+    out   = raster.copy()
+    state = numpy.full(h, 255, dtype = numpy.uint8)
+    count = numpy.full(h, run, dtype = numpy.int32)
+    
+    for x in range(1, w):
+        keep      = count < run
+        out[:, x] = numpy.where(keep, state, raster[:, x])
+        count     = numpy.where(out[:, x] == state, count + 1, 1)
+        state     = out[:, x]
+    
+    return out
+
+
+def rates(raster, width, speed):
+    # Count of moves, count of burning rows and peak count of moves per
+    # second at given burn speed. Peak is taken over consecutive moves
+    # within row as planner buffer sees them.
+    h, w  = raster.shape
+    sweep = numpy.full((h, w + 1), 255, dtype = numpy.int16)
+    
+    sweep[:, 1:w] = raster[:, 1:]
+    
+    sweep = sweep.ravel()
+    idx   = numpy.flatnonzero(sweep[:-1] != sweep[1:])
+    ys    = idx // (w + 1)
+    
+    if 0 == idx.size:
+        return 0, 0, 0
+    
+    k     = min(PLANNER_MOVES, numpy.bincount(ys).max())
+    same  = ys[k - 1:] == ys[:ys.size - k + 1]
+    span  = (idx[k - 1:] - idx[:idx.size - k + 1])[same]
+    peak  = 0
+    
+    if span.size and k > 1:
+        peak = (k - 1) * speed / 60 / (span.min() * width)
+    
+    return idx.size, numpy.unique(ys).size, peak
+
+
+def row_moves(row, y, job):
+    # Build sweep of row - start point, pixels and end point,
+    # odd rows are mirrored to get zig-zag lines
+    w     = row.shape[0]
+    sweep = numpy.empty(w + 1, dtype = numpy.int16)
+    
+    sweep[0] = 255
+    
+    if 0 == y % 2:
+        sweep[1:w] = row[1:]
+    else:
+        sweep[1:w] = row[:0:-1]
+    
+    sweep[w] = sweep[w - 1]
+    
+    # Trim white margins, so sweep starts just before first burning
+    # pixel and ends with the last one. White rows are skipped.
+    lo, hi = 0, w
+    last   = y == job['h'] - 1 and not job['overscan']
+    
+    if job['trim']:
+        burn = numpy.flatnonzero(sweep < 255)
+        
+        if 0 == burn.size:
+            return []
+        
+        lo, hi = burn[0] - 1, burn[-1]
+        last   = False
+    
+    # Optimize level 2 - keep only last point of each run with
+    # the same intensity. Next row always starts with 255, so
+    # row end is kept only when it burns.
+    idx = lo + numpy.flatnonzero(sweep[lo:hi] != sweep[lo + 1:hi + 1])
+    
+    if not last and not 255 == sweep[hi]:
+        idx = numpy.append(idx, hi)
+    
+    cs = sweep[idx].tolist()
+    
+    if 0 == y % 2:
+        xs = idx.tolist()
+    else:
+        xs = (w - idx).tolist()
+    
+    width = job['width']
+    yy    = y * width
+    moves = [((x, y), (x * width, yy), c, False) for x, c in zip(xs, cs)]
+    
+    # Compensate laser latency on reverse direction rows
+    if job['shift'] and not 0 == y % 2:
+        moves = [(m[0], (m[1][0] + job['shift'], yy), m[2], m[3]) for m in moves]
+    
+    # Travel to start of trimmed sweep is rapid move
+    if job['trim'] and moves:
+        moves[0] = moves[0][:3] + (True,)
+    
+    # Overscan - head accelerates before sweep start and decelerates
+    # after sweep end with laser off, so whole sweep burns at constant
+    # speed. Sweep start is reached at burn speed then.
+    if job['overscan'] and moves:
+        d        = job['overscan'] if 0 == y % 2 else -job['overscan']
+        start    = moves[0]
+        end      = moves[-1]
+        moves[0] = start[:3] + (False,)
+        
+        moves.insert(0, (start[0], (start[1][0] - d, yy), 255, start[3]))
+        moves.append(   (end[0],   (end[1][0]   + d, yy), 255, False))
+    
+    return moves
+
+
+
+def rasterize_band(band):
+    # Rasterize and format band of rows. First move is returned
+    # separately, because its format depends on previous band.
+    raster, y0, job = band
+    
+    moves = (convert(m, job) for y in range(y0, y0 + raster.shape[0])
+                               for m in row_moves(raster[y - y0], y, job))
+    first = next(moves, None)
+    
+    if first is None:
+        return None, '', None
+    
+    lines, last = (format_compact if job['compact'] else format_moves)(moves, first)
+    return first, ''.join(lines), last
+
+
+def convert(s, job):
+    intensity = 255 - s[2]
+    
+    if not 0 == intensity:
+        intensity = (intensity * job['rng']) // 255 + job['min']
+    
+    return (s[1][0] + job['margin'], job['size_y'] - s[1][1]), intensity, job['travel'] if s[3] else job['speed']
+
+
+def format_moves(moves, last):
+    lines = []
+    
+    for current in moves:
+        if current == last:
+            continue
+        
+        line = 'G1'
+        
+        if not last[0][0] == current[0][0]:
+            line += ' X{:.3f}'.format(current[0][0])
+        
+        if not last[0][1] == current[0][1]:
+            line += ' Y{:.3f}'.format(current[0][1])
+        
+        line += ' S{}'.format(current[1])
+        
+        if not last[2] == current[2]:
+            line += ' F{}'.format(current[2])
+        
+        lines.append(line + '\n')
+        last = current
+    
+    return lines, last
+
+
+def format_compact(moves, last):
+    # Coordinates are compared and formatted as integer micrometers,
+    # unchanged words and spaces are left out (power is modal)
+    lines = []
+    lx    = round(last[0][0] * 1000)
+    ly    = round(last[0][1] * 1000)
+    
+    for current in moves:
+        (x, y), s, f = current
+        x            = round(x * 1000)
+        y            = round(y * 1000)
+        line         = 'G1'
+        
+        if not lx == x:
+            line += 'X' + fixed(x)
+        
+        if not ly == y:
+            line += 'Y' + fixed(y)
+        
+        if not last[1] == s:
+            line += POWERS[s] if s < len(POWERS) else 'S{}'.format(s)
+        
+        if not last[2] == f:
+            line += 'F{}'.format(f)
+        
+        if 'G1' == line:
+            continue
+        
+        lines.append(line + '\n')
+        lx, ly, last = x, y, current
+    
+    return lines, last
+
+
+def fixed(um):
+    if um < 0:
+        return '-' + fixed(-um)
+    
+    return str(um // 1000) + FRACTIONS[um % 1000]
+
+
+
+def trace(mask):
+    # Outlines of burned regions as closed paths of pixel corner
+    # coordinates (last point repeats the first one). Holes are paths
+    # of opposite direction.
+    h, w   = mask.shape
+    padded = numpy.zeros((h + 2, w + 2), dtype = numpy.uint8)
+    
+    padded[1:-1, 1:-1] = mask
+    
+    case   = padded[:-1, :-1] * 8 + padded[:-1, 1:] * 4 + padded[1:, 1:] * 2 + padded[1:, :-1]
+    stride = 2 * w + 4
+    starts = []
+    ends   = []
+    
+    # Edge midpoints are keyed by doubled coordinates, so neighbour
+    # cells share them
+    for c, segments in enumerate(MARCHING):
+        if not segments:
+            continue
+        
+        i, j = numpy.nonzero(case == c)
+        
+        for (ax, ay), (bx, by) in segments:
+            starts.append((2 * i + ay + 1) * stride + 2 * j + ax + 1)
+            ends.append(  (2 * i + by + 1) * stride + 2 * j + bx + 1)
+    
+    if not starts:
+        return []
+    
+    # Every midpoint starts one segment and ends another one, so
+    # successors form cycles
+    starts = numpy.concatenate(starts)
+    ends   = numpy.concatenate(ends)
+    order  = numpy.argsort(starts)
+    succ   = order[numpy.searchsorted(starts[order], ends)].tolist()
+    seen   = numpy.zeros(starts.size, dtype = numpy.bool_)
+    paths  = []
+    
+    for first in range(starts.size):
+        if seen[first]:
+            continue
+        
+        loop = [first]
+        seen[first] = True
+        k           = succ[first]
+        
+        while not k == first:
+            loop.append(k)
+            seen[k] = True
+            k       = succ[k]
+        
+        keys = starts[loop + [first]]
+        paths.append(numpy.stack(((keys % stride - 1) / 2, (keys // stride - 1) / 2), axis = 1))
+    
+    return paths
+
+
+def simplify_path(points, tolerance):
+    # Douglas-Peucker, closed path is split at the point farthest
+    # from its start
+    keep  = numpy.zeros(len(points), dtype = numpy.bool_)
+    stack = [(0, len(points) - 1)]
+    
+    keep[0] = keep[-1] = True
+    
+    while stack:
+        a, b = stack.pop()
+        
+        if b - a < 2:
+            continue
+        
+        chord = points[b] - points[a]
+        rel   = points[a + 1:b] - points[a]
+        norm  = math.hypot(*chord)
+        
+        if norm:
+            d = numpy.abs(chord[0] * rel[:, 1] - chord[1] * rel[:, 0]) / norm
+        else:
+            d = numpy.hypot(rel[:, 0], rel[:, 1])
+        
+        k = int(numpy.argmax(d))
+        
+        if d[k] > tolerance:
+            keep[a + 1 + k] = True
+            stack.append((a, a + 1 + k))
+            stack.append((a + 1 + k, b))
+    
+    return points[keep]
+
+
+def hatch(paths, angle, spacing):
+    # Scanlines at angle (counterclockwise on machine, pixel y goes
+    # down) crossing closed paths. Inside segments (even-odd rule) of
+    # consecutive scanlines which overlap are chained to serpentine
+    # blocks, so regions are filled one by one. Third column of block
+    # tells whether move to the point burns.
+    a    = -math.radians(angle)
+    c, s = math.cos(a), math.sin(a)
+    ends = [(p[:-1], p[1:]) for p in paths if len(p) > 2]
+    
+    if not ends:
+        return []
+    
+    p0 = numpy.concatenate([e[0] for e in ends])
+    p1 = numpy.concatenate([e[1] for e in ends])
+    u0 = ( p0[:, 0] * c + p0[:, 1] * s)
+    v0 = (-p0[:, 0] * s + p0[:, 1] * c) / spacing
+    u1 = ( p1[:, 0] * c + p1[:, 1] * s)
+    v1 = (-p1[:, 0] * s + p1[:, 1] * c) / spacing
+    
+    # Edge crosses scanlines k with min(v) <= k < max(v)
+    lo = numpy.ceil(numpy.minimum(v0, v1)).astype(numpy.int64)
+    n  = numpy.ceil(numpy.maximum(v0, v1)).astype(numpy.int64) - lo
+    e  = numpy.repeat(numpy.arange(n.size), n)
+    k  = lo[e] + numpy.arange(e.size) - numpy.repeat(numpy.cumsum(n) - n, n)
+    u  = u0[e] + (k - v0[e]) / (v1[e] - v0[e]) * (u1[e] - u0[e])
+    
+    order    = numpy.lexsort((u, k))
+    k, u     = k[order], u[order]
+    segments = zip(k[0::2].tolist(), u[0::2].tolist(), u[1::2].tolist())
+    
+    # Segment continues block of previous scanline it overlaps
+    blocks   = []
+    previous = []
+    current  = []
+    line     = None
+    
+    for kk, a0, a1 in segments:
+        if not kk == line:
+            previous = current if line == kk - 1 else []
+            current  = []
+            line     = kk
+        
+        for block in previous:
+            if block[-1][1] < a1 and a0 < block[-1][2]:
+                previous.remove(block)
+                break
+        else:
+            block = []
+            blocks.append(block)
+        
+        block.append((kk, a0, a1))
+        current.append(block)
+    
+    result = []
+    
+    for block in blocks:
+        points = []
+        
+        for i, (kk, a0, a1) in enumerate(block):
+            if i % 2:
+                a0, a1 = a1, a0
             
-            if (not chunk[-1][0][0] == chunk[-2][0][0]  or
-                not chunk[-1][0][1] == chunk[-2][0][1]) and \
-                not chunk[-1][2]    == chunk[-2][2]:
-                    moves_opt.append(chunk[-2])
-                    chunk = [chunk[-1]]
+            points.append((a0, kk * spacing, 0))
+            points.append((a1, kk * spacing, 1))
         
+        points = numpy.array(points)
+        x      = points[:, 0] * c - points[:, 1] * s
+        y      = points[:, 0] * s + points[:, 1] * c
+        result.append(numpy.stack((x, y, points[:, 2]), axis = 1))
+    
+    return result
+
+
+def order_paths(paths, closed):
+    # Greedy nearest neighbour order starting at origin. Closed paths
+    # may start at some of their vertices, open paths at either end.
+    owner  = []
+    starts = []
+    points = []
+    
+    for i, path in enumerate(paths):
+        if closed:
+            idx = numpy.unique(numpy.linspace(0, len(path) - 2, min(CANDIDATES, len(path) - 1)).astype(int))
+        else:
+            idx = numpy.array([0, len(path) - 1])
         
+        owner.append(numpy.full(idx.size, i))
+        starts.append(idx)
+        points.append(path[idx, :2])
+    
+    if not paths:
+        return []
+    
+    owner  = numpy.concatenate(owner)
+    starts = numpy.concatenate(starts)
+    points = numpy.concatenate(points)
+    left   = numpy.ones(owner.size, dtype = numpy.bool_)
+    pos    = numpy.zeros(2)
+    result = []
+    
+    for _ in paths:
+        d    = ((points - pos)**2).sum(axis = 1)
+        k    = int(numpy.argmin(numpy.where(left, d, numpy.inf)))
+        path = paths[owner[k]]
         
-        self.moves = moves_opt
+        if closed:
+            path = numpy.concatenate((path[starts[k]:-1], path[:starts[k] + 1]))
+        elif starts[k]:
+            path = path[::-1].copy()
+            
+            # Burn flags belong to moves, not points
+            if path.shape[1] > 2:
+                path[:, 2] = numpy.concatenate(([0], path[:-1, 2]))
         
-        if file:
-            print('Writing PNG bitmap to ', file)
-            bitmap.save(file)
+        left[owner == owner[k]] = False
+        pos                     = path[-1, :2]
+        result.append(path)
+    
+    return result
+
+
+def parse_offsets(text):
+    # Calibration table in form "speed:offset,speed:offset,..."
+    if not text:
+        return None
+    
+    offsets = []
+    
+    for i in text.split(','):
+        speed, offset = i.split(':')
+        offsets.append((float(speed), float(offset)))
+    
+    return offsets
 
 
 
 class GCode:
-    def __init__(self, file, vectorized, speed, marker_cycles, min, max, init_comment = '; Built by vectorizer.py'):
+    def __init__(self, file, vectorized, speed, marker_cycles, min, max, init_comment = '; Built by vectorizer.py', jobs = 1, accel = 0, offsets = None, compact = False):
         print('\tCreating G-CODE graphics ...')
-        print('\t\tBurn speed {} mm/min'.format(speed))
         self.file          = file
         self.vectorized    = vectorized
         self.initial       = [init_comment,
@@ -123,16 +807,103 @@ class GCode:
                               'M300 S1320 P150',
                               'M300 S660 P150',
                               'M300 S1320 P150']
-        self.burn_speed    = speed
         self.marker_cycles = marker_cycles
         self.min           = min
         self.rng           = max - min
         self.size_x        = vectorized.size[0][0]
         self.size_y        = vectorized.size[0][1]
+        self.jobs          = jobs
+        self.accel         = accel
+        self.offsets       = sorted(offsets) if offsets else None
+        self.compact       = compact
+        
+        self._speed(speed)
+    
+    
+    def tune(self, rate = 0, baud = 0):
+        # Estimate engraving code before writing it and when it needs more
+        # commands per second than firmware or serial line can handle,
+        # simplify image and then slow down
+        lines, size, peak = self.estimate()
+        budget            = 0
+        
+        if rate:
+            budget = rate
+        
+        if baud and size:
+            budget = min(budget or baud, baud / 10 / (size / lines))
+        
+        if not budget or peak <= budget:
+            return
+        
+        print('\t\tOver budget of {:.0f} commands/s - tuning'.format(budget))
+        
+        for step in self._simplify():
+            lines, size, peak = self.estimate()
+            
+            if peak <= budget:
+                return
+        
+        self._speed(int(self.burn_speed * budget / peak))
+        self.estimate()
+    
+    
+    def _simplify(self):
+        # Steps of image simplification, each one reduces count of commands
+        if not self.vectorized.dither:
+            for bits in range(7, TUNE_BITS - 1, -1):
+                self.vectorized.simplify(bits, 1)
+                yield
+        
+        for run in range(2, TUNE_RUN + 1):
+            self.vectorized.simplify(TUNE_BITS, run)
+            yield
+    
+    
+    def estimate(self):
+        # Moves are counted from raster, length of line is measured on
+        # a few formatted bands spread over image
+        moves, rows, peak = rates(self.vectorized.raster, self.vectorized.width, self.burn_speed)
+        
+        if self.overscan:
+            moves += 2 * rows
+        
+        job    = self._job()
+        bands  = list(self.vectorized.bands(1))
+        sample = [rasterize_band((*band, job)) for band in bands[::max(1, len(bands) // SAMPLE_BANDS)]]
+        count  = sum(1 + text.count('\n') for first, text, last in sample if first)
+        size   = moves * sum(len(text) for first, text, last in sample) / max(1, count)
+        
+        print('\t\tEstimated {} lines, {:.0f} kB, peak {:.0f} commands/s ({:.0f} B/s)'.format(moves,
+                                                                                          size / 1024,
+                                                                                          peak,
+                                                                                          peak * size / max(1, moves)))
+        return moves, size, peak
+    
+    
+    def _speed(self, speed):
+        print('\t\tBurn speed {} mm/min'.format(speed))
+        self.burn_speed = speed
+        
+        # Shift of reverse rows interpolated from calibration table
+        self.shift = 0
+        
+        if self.offsets:
+            self.shift = float(numpy.interp(speed, [o[0] for o in self.offsets], [o[1] for o in self.offsets]))
+            print('\t\tReverse rows shift {:.3f} mm'.format(self.shift))
+        
+        # Distance needed to reach burn speed from stand still
+        self.overscan = 0
+        
+        if self.accel:
+            self.overscan = (speed / 60)**2 / (2 * self.accel)
+            print('\t\tOverscan {:.3f} mm at {} mm/s^2'.format(self.overscan, self.accel))
     
     
     def save(self):
-        with open(self.file, 'w') as f:
+        left, right = self._margins()
+        
+        with open(self.file, 'w', buffering = WRITE_BUFFER) as f:
             f.write('; Init Marlin Laser code\n')
             
             for i in self.initial:
@@ -140,10 +911,10 @@ class GCode:
             
             f.write('M300 S660 P50\n')
             f.write('M300 S330 P50\n')
-            f.write('G93 X{} Y{} I0 J0 F5000 S1 ; Focuss laser\n'.format(self.size_x // 2, self.size_y // 2))
+            f.write('G93 X{} Y{} I0 J0 F5000 S1 ; Focuss laser\n'.format(round(left + self.size_x // 2, 3), self.size_y // 2))
             f.write('M300 S660 P50\n')
             f.write('M300 S330 P50\n')
-            f.write('G93 X0 Y0 I{:.3f} J{:.3f} F5000 S1 ; Locate burning area\n'.format(self.size_x, self.size_y))
+            f.write('G93 X0 Y0 I{:.3f} J{:.3f} F5000 S1 ; Locate burning area\n'.format(left + self.size_x + right, self.size_y))
             
             f.write('\nG1 X0 Y0 S0 F3000 ; Move to origin\n')
             f.write('M300 S660 P150      ; Start burning\n')
@@ -160,30 +931,22 @@ class GCode:
             
             f.write('\n\n; Engraving code\n')
             
-            f.write('G1 X{:.3f} Y{:.3f} F3000 S0 ; Move to origin\n'.format(*self._convert(self.vectorized.moves[0])[0]))
-            f.write('G1 F{}                     ; Set burn speed\n\n'.format(self.burn_speed))
+            last = None
             
-            last = self._convert(self.vectorized.moves[0])
-            
-            for i in self.vectorized.moves:
-                current = self._convert(i)
-                delta   = ((last[0][0] - current[0][0],
-                            last[0][1] - current[0][1]),
-                            last[1]    - current[1])
-                
-                if 0 == delta[0][0] and 0 == delta[0][1] and 0 == delta[1]:
+            for first, text, band_last in self._bands():
+                if first is None:
                     continue
                 
-                f.write('G1')
+                if last is None:
+                    # The very first move is origin of engraving
+                    f.write('G1 X{:.3f} Y{:.3f} F3000 S0 ; Move to origin\n'.format(*first[0]))
+                    f.write('G1 F{}                     ; Set burn speed\n\n'.format(self.burn_speed))
+                    band_last = first[:2] + (self.burn_speed,) if first is band_last else band_last
+                else:
+                    f.write(''.join((format_compact if self.compact else format_moves)((first,), last)[0]))
                 
-                if not 0 == delta[0][0]:
-                    f.write(' X{:.3f}'.format(current[0][0]))
-                
-                if not 0 == delta[0][1]:
-                    f.write(' Y{:.3f}'.format(current[0][1]))
-                
-                f.write(' S{}\n'.format(current[1]))
-                last = current
+                f.write(text)
+                last = band_last
             
             
             f.write('\n; Finalize Marlin Laser code\n')
@@ -192,16 +955,137 @@ class GCode:
                 f.write('{}\n'.format(i))
     
     
-    def _convert(self, s):
-        intensity = 255 - s[2]
+    def _job(self):
+        return {'h'        : self.vectorized.raster.shape[0],
+                'width'    : self.vectorized.width,
+                'trim'     : self.vectorized.trim,
+                'size_y'   : self.size_y,
+                'min'      : self.min,
+                'rng'      : self.rng,
+                'speed'    : self.burn_speed,
+                'travel'   : TRAVEL_SPEED,
+                'overscan' : self.overscan,
+                'shift'    : self.shift,
+                'margin'   : self._margins()[0],
+                'compact'  : self.compact}
+    
+    
+    def _shifts(self):
+        return [self.shift]
+    
+    
+    def _margins(self):
+        # Moves reach beyond image by overscan and shift of reverse rows.
+        # Marlin clamps moves to X0 (software endstops), so the whole job
+        # is moved right by left margin instead.
+        shifts = self._shifts()
+        return self.overscan + max(0, -min(shifts)), self.overscan + max(0, max(shifts))
+    
+    
+    def _bands(self):
+        job   = self._job()
+        bands = ((*band, job) for band in self.vectorized.bands(BAND_HEIGHT if self.jobs > 1 else 1))
         
-        if not 0 == intensity:
-            intensity = (intensity * self.rng) // 255 + self.min
+        if self.jobs < 2:
+            yield from map(rasterize_band, bands)
+            return
         
-        return (s[1][0], self.size_y - s[1][1]), intensity 
+        print('\t\tRasterizing in {} processes'.format(self.jobs))
+        
+        with multiprocessing.Pool(self.jobs) as pool:
+            yield from pool.imap(rasterize_band, bands)
+
 
 
 
+class ContourGCode(GCode):
+    def __init__(self, *args, threshold = 128, tolerance = None, **kwargs):
+        # Outlines of pixels darker than threshold burned at full power,
+        # simplified to tolerance in mm (laser path width by default)
+        GCode.__init__(self, *args, **kwargs)
+        print('\t\tTracing contours')
+        self.loops     = trace(self.vectorized.raster < threshold)
+        self.tolerance = tolerance or self.vectorized.width
+    
+    
+    def estimate(self):
+        # Everything is formatted, peak is taken over consecutive moves
+        # within path as planner buffer sees them
+        bands = list(self._bands())
+        moves = sum(1 + text.count('\n') for first, text, last in bands)
+        size  = sum(len(text) for first, text, last in bands)
+        peak  = 0
+        
+        for path in self._paths():
+            k = min(PLANNER_MOVES, len(path) - 1)
+            
+            if k > 1:
+                length = numpy.concatenate(([0], numpy.cumsum(numpy.hypot(*numpy.diff(path, axis = 0).T))))
+                span   = (length[k:] - length[:-k]).min() * self.vectorized.width
+                peak   = max(peak, (k - 1) * self.burn_speed / 60 / max(span, 1e-3))
+        
+        print('\t\tEstimated {} lines, {:.0f} kB, peak {:.0f} commands/s ({:.0f} B/s)'.format(moves,
+                                                                                          size / 1024,
+                                                                                          peak,
+                                                                                          peak * size / max(1, moves)))
+        return moves, size, peak
+    
+    
+    def _simplify(self):
+        for step in range(TUNE_STEPS):
+            self.tolerance *= 2
+            print('\t\tSimplifying contours to {:.3f} mm'.format(self.tolerance))
+            yield
+    
+    
+    def _paths(self):
+        tolerance = self.tolerance / self.vectorized.width
+        return [simplify_path(loop, tolerance) for loop in self.loops]
+    
+    
+    def _closed(self):
+        return True
+    
+    
+    def _margins(self):
+        # Paths have neither overscan nor shift
+        return 0, 0
+    
+    
+    def _bands(self):
+        # Each path is a band - travel to its start and burn along it
+        job    = self._job()
+        format = format_compact if self.compact else format_moves
+        width  = self.vectorized.width
+        
+        for path in order_paths(self._paths(), self._closed()):
+            points = (path[:, :2] * width).tolist()
+            burns  = path[:, 2].tolist() if path.shape[1] > 2 else [1] * len(points)
+            first  = convert(((0, 0), points[0], 255, True), job)
+            moves  = (convert(((0, 0), p, 0 if b else 255, False), job) for p, b in zip(points[1:], burns[1:]))
+            
+            lines, last = format(moves, first)
+            yield first, ''.join(lines), last
+
+
+
+class HatchGCode(ContourGCode):
+    def __init__(self, *args, angle = 0, spacing = None, **kwargs):
+        # Regions inside contours are filled by parallel lines at angle
+        # in degrees, spacing in mm (laser path width by default)
+        ContourGCode.__init__(self, *args, **kwargs)
+        self.angle   = angle
+        self.spacing = spacing or self.vectorized.width
+    
+    
+    def _paths(self):
+        return hatch(ContourGCode._paths(self), self.angle, self.spacing / self.vectorized.width)
+    
+    
+    def _closed(self):
+        return False
+
+
 if __name__ == '__main__':
     import click
     
@@ -218,12 +1102,40 @@ if __name__ == '__main__':
     @click.option('--max',    '-x', type    = int,                       default  = 255,  help = 'Maximal intensity')
     @click.option('--bits',   '-t',                                      default  = 8,    help = 'Bit resolution of image')
     @click.option('--bw',     '-l', is_flag = True,                                       help = 'Rather use BW instead of grayscale')
-    def run(input, output, png, width, height, dot, speed, count, min, max, bits, bw):
+    @click.option('--dither', '-e', type    = int,                       default  = 0,    help = 'Rather use error diffused BW with runs of at least given count of pixels')
+    @click.option('--tiled',  '-g', is_flag = True,                                       help = 'Resample huge input image in strips of rows')
+    @click.option('--cache',  '-k', type    = click.Path(),              default  = None, help = 'Directory caching quantized rasters between runs')
+    @click.option('--limit',  '-q', type    = int,                       default  = 256,  help = 'Size limit of raster cache in MB')
+    @click.option('--mode',   '-n', type    = click.Choice(['raster', 'contour', 'hatch']), default = 'raster', help = 'Raster sweeps, outlines of dark regions or their hatch fill')
+    @click.option('--level',  '-v', type    = int,                       default  = 128,  help = 'Darkest intensity outside of contours')
+    @click.option('--smooth', '-y', type    = float,                     default  = None, help = 'Contour simplification tolerance in mm (default dot)')
+    @click.option('--angle',  '-A', type    = float,                     default  = 0,    help = 'Hatch lines angle in degrees')
+    @click.option('--spacing','-L', type    = float,                     default  = None, help = 'Hatch lines spacing in mm (default dot)')
+    @click.option('--trim',   '-r', is_flag = True,                                       help = 'Skip white rows and white row margins')
+    @click.option('--accel',  '-a', type    = float,                     default  = 0,    help = 'Head acceleration in mm/s^2 for sweep overscan (0 disables overscan)')
+    @click.option('--offset', '-f', type    = str,                       default  = None, help = 'Reverse rows shift table "speed:mm,speed:mm,..." (see calibrate.py)')
+    @click.option('--compact','-z', is_flag = True,                                       help = 'Write shortest G-CODE (no spaces, trailing zeros and repeated power)')
+    @click.option('--rate',   '-b', type    = int,                       default  = 0,    help = 'Peak commands per second firmware handles (0 - no limit)')
+    @click.option('--baud',   '-u', type    = int,                       default  = 0,    help = 'Baud rate of serial line feeding G-CODE (0 - SD card)')
+    @click.option('--jobs',   '-j', type    = int,                       default  = 1,    help = 'Count of processes rasterizing image')
+    def run(input, output, png, width, height, dot, speed, count, min, max, bits, bw, dither, tiled, cache, limit, mode, level, smooth, angle, spacing, trim, accel, offset, compact, rate, baud, jobs):
         print('Vectorizing ', input)
-        vectorized = Vectorize(input, (width, height), dot, bits, bw, png)
+        cache      = Cache(cache, limit) if cache else None
+        vectorized = Vectorize(input, (width, height), dot, bits, bw, png, trim, dither, tiled, cache)
         
         print('Writing G-CODE to ', output)
-        gcode = GCode(output, vectorized, speed, count, min, max,
+        kind  = GCode
+        extra = {}
+        
+        if 'contour' == mode:
+            kind  = ContourGCode
+            extra = dict(threshold = level, tolerance = smooth)
+        
+        if 'hatch' == mode:
+            kind  = HatchGCode
+            extra = dict(threshold = level, tolerance = smooth, angle = angle, spacing = spacing)
+        
+        gcode = kind(output, vectorized, speed, count, min, max,
 '''; Parameters:
 ;    vectorizer.input  = {}
 ;    vectorizer.output = {}
@@ -237,7 +1149,8 @@ if __name__ == '__main__':
 ;    vectorizer.max    = {}
 ;    vectorizer.bits   = {}
 ;    vectorizer.bw     = {}
-'''.format(input, output, png, width, height, dot, speed, count, min, max, bits, bw))
+'''.format(input, output, png, width, height, dot, speed, count, min, max, bits, bw), jobs, accel, parse_offsets(offset), compact, **extra)
+        gcode.tune(rate, baud)
         gcode.save()
         print('Done ...')
     